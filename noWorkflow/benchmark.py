@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+import sql_to_json
+from make_synthetic_db import DEFAULTS, make_synthetic_db
+
+class StageMemory(sql_to_json.ProfileHook):
+    """ records the peak traced memory while each stage or profiled function runs
+    a stage's peak includes the stages nested in it """
+
+    def __init__(self):
+        self.peaks = {}
+        self.stack = []
+
+    def start(self, name):
+        # the peak so far belongs to the stage around this one, before it is reset
+        if len(self.stack) > 0:
+            self.stack[-1] = max(self.stack[-1], tracemalloc.get_traced_memory()[1])
+        self.stack.append(0)
+        tracemalloc.reset_peak()
+
+    def end(self, name, seconds, own_seconds):
+        peak = max(self.stack.pop(), tracemalloc.get_traced_memory()[1])
+        self.peaks[name] = max(self.peaks.get(name, 0), peak)
+        if len(self.stack) > 0:
+            self.stack[-1] = max(self.stack[-1], peak)
+        tracemalloc.reset_peak()
+
+def run_conversion(db_file, trial_num_list, output_json_file, memory=False):
+    """ converts the trials once, returning phase times, peak memory per stage,
+    total seconds and the node and edge counts
+    memory is traced in a separate run, since tracing slows the conversion down """
+
+    sql_to_json.phase_times.clear()
+    sql_to_json.script_cache.clear()
+
+    hook = StageMemory()
+    if memory:
+        tracemalloc.start()
+        sql_to_json.add_profile_hook(hook)
+
+    start = time.perf_counter()
+    counts = sql_to_json.link_DDGs(trial_num_list, db_file, output_json_file)
+    total = time.perf_counter() - start
+
+    if memory:
+        sql_to_json.remove_profile_hook(hook)
+        tracemalloc.stop()
+
+    return dict(sql_to_json.phase_times), hook.peaks, total, counts
+
+def benchmark(dimension, scales, knobs, memory=True):
+    """ converts a synthetic database for each scale of one knob, the others fixed, and prints a report """
+
+    for scale in scales:
+        current = dict(knobs)
+        current[dimension] = knobs[dimension] * scale
+
+        with tempfile.TemporaryDirectory() as directory:
+            db_file = make_synthetic_db(directory, **current)
+            os.makedirs(os.path.join(directory, "results"))
+            output_json_file = os.path.join(directory, "results", "out.json")
+            trial_num_list = list(range (1, current["trials"]+1))
+
+            times, peaks, total, counts = run_conversion(db_file, trial_num_list, output_json_file)
+            if memory:
+                ignored, peaks, ignored, ignored = run_conversion(db_file, trial_num_list, output_json_file, memory=True)
+
+        nodes = counts["activity"] - 1 + counts["entity"]
+        print("%s x%d (%s=%d): %.3fs, %d nodes, %.0f nodes/sec" % (dimension, scale, dimension, current[dimension], total, nodes, nodes / total))
+        print("    %-24s %10s %10s" % ("stage", "seconds", "peak MB"))
+        for stage in times:
+            peak = "%10.1f" % (peaks[stage] / 1e6) if stage in peaks else "%10s" % "-"
+            print("    %-24s %10.3f %s" % (stage, times[stage], peak))
+        sys.stdout.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks sql_to_json.py on synthetic noWorkflow databases, scaling one size knob at a time.")
+    parser.add_argument("--dimension", action="append", choices=sorted(DEFAULTS), help="knob to scale, repeatable (default: all)")
+    parser.add_argument("--scales", default="1,2,4", help="comma separated multipliers for the knob")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run that measures peak memory")
+    for knob in DEFAULTS:
+        parser.add_argument("--" + knob.replace("_", "-"), type=int, default=DEFAULTS[knob], help="base size")
+    args = parser.parse_args()
+
+    knobs = {}
+    for knob in DEFAULTS:
+        knobs[knob] = getattr(args, knob)
+    scales = [int(scale) for scale in args.scales.split(",")]
+
+    for dimension in args.dimension or list(DEFAULTS):
+        benchmark(dimension, scales, knobs, not args.no_memory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import hashlib
+import difflib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import sql_to_json
+
+# most pairs of children of one function or loop aligned by difflib, past it children are paired in order
+ALIGN_LIMIT = 250000
+
+# characters of each return value kept in the report
+VALUE_PREVIEW = 200
+
+# changes listed in the report by the command line. every change is counted
+MAX_CHANGES = 1000
+
+def step_digest(tree, i):
+    """ fingerprint of process node i by itself: type, name, line, return values and file accesses """
+
+    return hashlib.sha1(repr((tree["types"][i], tree["names"][i], tree["lines"][i],
+                              tree["values"][i], tree["files"][i])).encode()).digest()
+
+def build_tree(trial):
+    """ fingerprints the steps of a trial from sql_to_json.extract_trial, Merkle style:
+    a function or loop, from its Start node to its Finish node, is fingerprinted by itself and its children,
+    so two subtrees with the same fingerprint ran the same steps with the same values and files
+    returns lists indexed by process number, 0 being a root around the script's nodes """
+
+    events, p_total, finish_node, first_step, script_name = trial
+    n = p_total + 1
+
+    tree = {"types": [None] * n, "names": [None] * n, "lines": [None] * n, "values": [()] * n, "files": [()] * n,
+            "fingerprints": [None] * n, "children": {}, "ends": {}, "trial": trial}
+
+    # return values come as data nodes and wasGeneratedBy edges, files as file events
+    data_values = {}
+    for event in events:
+        if event[0] == "activity":
+            if event[1] != "environment":
+                i = int(event[1][1:])
+                tree["types"][i] = event[2].get("rdt:type")
+                tree["names"][i] = event[2].get("rdt:name")
+                tree["lines"][i] = event[2].get("rdt:startLine")
+        elif event[0] == "entity":
+            data_values[event[1]] = event[2].get("rdt:value")
+        elif event[0] == "wasGeneratedBy":
+            i = int(event[2]["prov:activity"][1:])
+            tree["values"][i] = tree["values"][i] + (data_values.pop(event[2]["prov:entity"], None), )
+        elif event[0] == "file":
+            i = int(event[1][1:])
+            file_access = event[3]
+            tree["files"][i] = tree["files"][i] + ((file_access["mode"], file_access["name"].split("/")[-1], file_access["hash"]), )
+
+    # (Start node, its hash so far, its children) for the open functions and loops
+    stack = [(0, hashlib.sha1(), [])]
+    for i in range (1, n):
+        if tree["types"][i] == "Start":
+            stack.append((i, hashlib.sha1(step_digest(tree, i)), []))
+            continue
+
+        if tree["types"][i] == "Finish":
+            if len(stack) == 1:
+                continue
+            j, h, children = stack.pop()
+            h.update(step_digest(tree, i))
+            tree["ends"][j] = i
+        else:
+            j = i
+            children = None
+
+        if children != None:
+            tree["children"][j] = children
+            tree["fingerprints"][j] = h.digest()
+        else:
+            tree["fingerprints"][j] = step_digest(tree, j)
+        stack[-1][1].update(tree["fingerprints"][j])
+        stack[-1][2].append(j)
+
+    # functions and loops still open at the end of the trial
+    while len(stack) > 1:
+        j, h, children = stack.pop()
+        tree["children"][j] = children
+        tree["ends"][j] = n-1
+        tree["fingerprints"][j] = h.digest()
+        stack[-1][1].update(tree["fingerprints"][j])
+        stack[-1][2].append(j)
+
+    tree["children"][0] = stack[0][2]
+    tree["ends"][0] = n-1
+    tree["fingerprints"][0] = stack[0][1].digest()
+
+    return tree
+
+def step_key(tree, i):
+    """ what two steps must share to be compared: type, name and line """
+
+    return (tree["types"][i], tree["names"][i], tree["lines"][i])
+
+def subtree_size(tree, i):
+    """ number of process nodes in subtree i, from its Start node to its Finish node """
+
+    return tree["ends"][i] - i + 1 if i in tree["ends"] else 1
+
+def describe(tree, i):
+    """ a step or subtree in the report """
+
+    values = [v[:VALUE_PREVIEW] if isinstance(v, str) else v for v in tree["values"][i]]
+    return {"id": "p" + str(i), "type": tree["types"][i], "name": tree["names"][i], "line": tree["lines"][i],
+            "values": values, "files": [list(f) for f in tree["files"][i]],
+            "steps": subtree_size(tree, i)}
+
+def add_change(report, change, a, b, i, j, path):
+    """ counts a changed, added or removed step or subtree, listing it while the report has room """
+
+    report["counts"][change] += 1
+    if change == "removed":
+        report["counts"]["steps removed"] += subtree_size(a, i)
+    elif change == "added":
+        report["counts"]["steps added"] += subtree_size(b, j)
+    else:
+        report["counts"]["steps changed"] += 1
+
+    if report["max changes"] == None or len(report["changes"]) < report["max changes"]:
+        entry = {"change": change, "path": path}
+        if i != None:
+            entry["a"] = describe(a, i)
+        if j != None:
+            entry["b"] = describe(b, j)
+        report["changes"].append(entry)
+
+    # highlighted in the overlay of trial b
+    if j != None:
+        report["marks"][j] = change
+    if i != None and change == "removed":
+        report["removed"][report["parent"]] = report["removed"].get(report["parent"], 0) + subtree_size(a, i)
+
+def align(a, b, ca, cb):
+    """ pairs the children of two functions or loops, skipping the identical ones at both ends
+    returns difflib opcodes over the rest, and the children skipped at both ends """
+
+    lo = 0
+    while lo < len(ca) and lo < len(cb) and a["fingerprints"][ca[lo]] == b["fingerprints"][cb[lo]]:
+        lo += 1
+    hi_a, hi_b = len(ca), len(cb)
+    while hi_a > lo and hi_b > lo and a["fingerprints"][ca[hi_a-1]] == b["fingerprints"][cb[hi_b-1]]:
+        hi_a -= 1
+        hi_b -= 1
+
+    ma, mb = ca[lo:hi_a], cb[lo:hi_b]
+    if len(ma) * len(mb) <= ALIGN_LIMIT:
+        matcher = difflib.SequenceMatcher(None, [step_key(a, i) for i in ma], [step_key(b, j) for j in mb], autojunk=False)
+        opcodes = matcher.get_opcodes()
+    else:
+        # too many to align, ie loops with different numbers of iterations: in order, the extra ones added or removed
+        k = min(len(ma), len(mb))
+        opcodes = [("equal", 0, k, 0, k), ("delete", k, len(ma), k, k), ("insert", k, k, k, len(mb))]
+
+    return ma, mb, opcodes, lo + len(ca) - hi_a
+
+def child_pairs(ma, mb, opcodes):
+    """ yields the children of two functions or loops from align in order, paired (x, y),
+    or (x, None) and (None, y) for the removed and added ones """
+
+    for tag, a1, a2, b1, b2 in opcodes:
+        if tag == "equal":
+            for x, y in zip(ma[a1:a2], mb[b1:b2]):
+                yield x, y
+        else:
+            for x in ma[a1:a2]:
+                yield x, None
+            for y in mb[b1:b2]:
+                yield None, y
+
+def open_subtree(a, b, i, j, path, report):
+    """ starts comparing subtree i of a with subtree j of b: their Start and Finish nodes, then their children
+    returns (the parent to restore, path of the children, their pairs from child_pairs) """
+
+    parent = report["parent"]
+    report["parent"] = j
+    report["marks"].setdefault(j, "contains changes")
+
+    # the Start and Finish nodes themselves, ie the return value of the function
+    if i > 0 and (step_digest(a, i) != step_digest(b, j) or step_digest(a, a["ends"][i]) != step_digest(b, b["ends"][j])):
+        add_change(report, "changed", a, b, i, j, path)
+        report["marks"][j] = "changed"
+
+    if i > 0:
+        path = path + [b["names"][j]]
+
+    ma, mb, opcodes, skipped = align(a, b, a["children"][i], b["children"][j])
+    report["counts"]["skipped"] += skipped
+
+    return parent, path, child_pairs(ma, mb, opcodes)
+
+def compare(a, b, i, j, path, report):
+    """ reports the differences between subtree i of a and subtree j of b, whose fingerprints differ
+    children with the same fingerprint are skipped without looking into them
+    the subtrees being compared are kept on a stack, so deep recursion in the trace is not recursion here """
+
+    stack = [open_subtree(a, b, i, j, path, report)]
+    while len(stack) > 0:
+        parent, path, pairs = stack[-1]
+
+        nested = None
+        for x, y in pairs:
+            if y == None:
+                add_change(report, "removed", a, b, x, None, path)
+            elif x == None:
+                add_change(report, "added", a, b, None, y, path)
+            elif a["fingerprints"][x] == b["fingerprints"][y]:
+                report["counts"]["skipped"] += 1
+            elif step_key(a, x) != step_key(b, y):
+                add_change(report, "removed", a, b, x, None, path)
+                add_change(report, "added", a, b, None, y, path)
+            elif x in a["children"] and y in b["children"]:
+                # compared before the rest of the children, as in a depth first walk
+                nested = (x, y)
+                break
+            else:
+                add_change(report, "changed", a, b, x, y, path)
+
+        if nested != None:
+            stack.append(open_subtree(a, b, nested[0], nested[1], path, report))
+        else:
+            stack.pop()
+            report["parent"] = parent
+
+def diff_trees(a, b, max_changes=None):
+    """ differences between two trees from build_tree, as a report dict:
+    changes lists the changed, added and removed steps (or whole functions and loops) with their values and files,
+    counts counts them, and the identical steps and subtrees that were skipped
+    max_changes: most changes listed, all are counted
+    marks and removed are what get_overlay highlights """
+
+    report = {"identical": a["fingerprints"][0] == b["fingerprints"][0], "changes": [], "max changes": max_changes,
+              "counts": {"changed": 0, "added": 0, "removed": 0, "steps changed": 0, "steps added": 0, "steps removed": 0, "skipped": 0},
+              "marks": {}, "removed": {}, "parent": 0}
+    if not report["identical"]:
+        # the scripts are compared even if their names differ
+        ca, cb = a["children"][0], b["children"][0]
+        if len(ca) == 1 and len(cb) == 1 and ca[0] in a["children"] and cb[0] in b["children"]:
+            compare(a, b, ca[0], cb[0], [], report)
+        else:
+            compare(a, b, 0, 0, [], report)
+
+    return report
+
+def get_overlay(b, report):
+    """ the Prov-JSON of trial b with its changed and added nodes highlighted by an rdt:diff attribute:
+    changed, added, or contains changes for the Start nodes of functions and loops with changes in them.
+    rdt:removedSteps counts the steps of trial a removed from a function or loop """
+
+    attributes = {}
+    for j, change in report["marks"].items():
+        if j == 0:
+            continue
+        # every node of an added function or loop
+        last = b["ends"][j] if change == "added" and j in b["ends"] else j
+        for k in range (j, last+1):
+            attributes.setdefault("p" + str(k), {})["rdt:diff"] = change
+    for j, steps in report["removed"].items():
+        if j > 0:
+            attributes.setdefault("p" + str(j), {})["rdt:removedSteps"] = str(steps)
+
+    # the nodes are highlighted in the recorded events, then merged like any trial
+    events = []
+    for event in b["trial"][0]:
+        if event[0] == "activity" and event[1] in attributes:
+            event = (event[0], event[1], dict(event[2], **attributes[event[1]]))
+        events.append(event)
+    trial = (events, ) + tuple(b["trial"][1:])
+
+    return sql_to_json.merge_trial(sql_to_json.get_compact_result(), trial, 1, 1, 1, {}, {}, None)[0]
+
+def diff_trials(db_a, trial_a, db_b, trial_b, max_changes=None, index_db_a=None, index_db_b=None):
+    """ compares two trials, which may come from two databases, each extracted on its own thread
+    returns the report from diff_trees and the tree of trial b for get_overlay """
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        trials = list(executor.map(sql_to_json.extract_trial, [db_a, db_b], [index_db_a, index_db_b], [None, None], [trial_a, trial_b]))
+
+    with sql_to_json.timed("diff"):
+        a, b = build_tree(trials[0]), build_tree(trials[1])
+        report = diff_trees(a, b, max_changes)
+
+    return report, b
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sql_to_json.py diff", description="Compares two trials step by step, skipping the functions and loops that ran identically.")
+    parser.add_argument("db", help="database noWorkflow created, ie path/to/.noworkflow/db.sqlite")
+    parser.add_argument("a", type=int, help="trial to compare")
+    parser.add_argument("b", type=int, help="trial to compare it with")
+    parser.add_argument("--db-b", help="database of trial b, if not db")
+    parser.add_argument("-o", "--output", default="-", help="JSON report to write, - for stdout (default)")
+    parser.add_argument("--overlay", help="also write the Prov-JSON of trial b with the differences highlighted")
+    parser.add_argument("--max-changes", type=int, default=MAX_CHANGES, help="most changes listed in the report, all are counted")
+    args = parser.parse_args(argv)
+
+    report, b = diff_trials(args.db, args.a, args.db_b or args.db, args.b, args.max_changes)
+
+    if args.overlay:
+        sql_to_json.write_output(get_overlay(b, report), args.overlay)
+
+    output = {"a": {"db": args.db, "trial": args.a}, "b": {"db": args.db_b or args.db, "trial": args.b},
+              "identical": report["identical"], "counts": report["counts"], "changes": report["changes"]}
+    sql_to_json.write_json(output, args.output)
+    if args.output == "-":
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import argparse
+from collections import OrderedDict, deque
+
+import sql_to_json
+
+# edge sections, with the attribute holding the earlier node and the later node of each edge
+# data flows from an entity to the activities that use it, and from an activity to what it generates
+EDGES = [("used", "prov:entity", "prov:activity"),
+         ("wasGeneratedBy", "prov:activity", "prov:entity"),
+         ("wasInformedBy", "prov:informant", "prov:informed")]
+
+# lineage closures of file entities kept by each LineageIndex
+CLOSURE_CACHE_SIZE = 256
+
+class LineageIndex:
+    """ adjacency indexes over a DDG for upstream and downstream lineage queries
+    ddg: a dict of Prov-JSON sections, ie loaded by read_ddg or the result of add_trials,
+    whose sections may be CompactSections or SpillSections, or a path read_ddg can read
+    informs: also follow wasInformedBy edges, from each step to the step after it.
+    without them lineage only follows the data """
+
+    def __init__(self, ddg, informs=False):
+        if isinstance(ddg, str):
+            ddg = sql_to_json.read_ddg(ddg)
+
+        # nodes are numbered, edges are lists of numbers in both directions
+        self.ids = []
+        self.numbers = {}
+        self.types = []
+        self.names = []
+        self.upstream_edges = []
+        self.downstream_edges = []
+
+        # (node number, downstream) -> tuple of node numbers, least recently used first
+        self.closures = OrderedDict()
+
+        for key in ("activity", "entity"):
+            for node_id, node in ddg.get(key, {}).items():
+                self.add_node(node_id, node.get("rdt:type"), node.get("rdt:name"))
+
+        for key, source, target in EDGES:
+            if key == "wasInformedBy" and not informs:
+                continue
+            for edge_id, edge in ddg.get(key, {}).items():
+                self.add_edge(edge[source], edge[target])
+
+    def add_node(self, node_id, node_type=None, name=None):
+        """ numbers a node, returning its number """
+
+        if node_id not in self.numbers:
+            self.numbers[node_id] = len(self.ids)
+            self.ids.append(node_id)
+            self.types.append(node_type)
+            self.names.append(name)
+            self.upstream_edges.append([])
+            self.downstream_edges.append([])
+        return self.numbers[node_id]
+
+    def add_edge(self, source, target):
+        """ adds an edge from the earlier node to the later one """
+
+        source, target = self.add_node(source), self.add_node(target)
+        self.downstream_edges[source].append(target)
+        self.upstream_edges[target].append(source)
+        self.closures.clear()
+
+    def find(self, name):
+        """ ids of the nodes with this id or name, ie every version of a file """
+
+        if name in self.numbers:
+            return [name]
+        return [self.ids[n] for n in range (0, len(self.ids)) if self.names[n] == name]
+
+    def node(self, node_id):
+        """ (type, name) of a node """
+
+        n = self.numbers[node_id]
+        return self.types[n], self.names[n]
+
+    def lineage(self, node_id, downstream=False):
+        """ ids of every node node_id depends on, or with downstream every node that depends on it
+        nearest first, except for parts reused from the cached closure of a file
+        only those nodes and their edges are visited, never the rest of the graph """
+
+        if node_id not in self.numbers:
+            raise KeyError("no node " + str(node_id) + " in the DDG")
+        start = self.numbers[node_id]
+
+        key = (start, downstream)
+        if key in self.closures:
+            self.closures.move_to_end(key)
+            return [self.ids[n] for n in self.closures[key]]
+
+        edges = self.downstream_edges if downstream else self.upstream_edges
+        seen = set([start])
+        order = []
+        queue = deque([start])
+
+        while len(queue) > 0:
+            for n in edges[queue.popleft()]:
+                if n in seen:
+                    continue
+                seen.add(n)
+                order.append(n)
+
+                # everything past a file whose closure is cached is already known
+                closure = self.closures.get((n, downstream))
+                if closure == None:
+                    queue.append(n)
+                    continue
+                for m in closure:
+                    if m not in seen:
+                        seen.add(m)
+                        order.append(m)
+
+        # files are asked about over and over, so their closures are kept
+        if self.types[start] == "File":
+            self.closures[key] = tuple(order)
+            if len(self.closures) > CLOSURE_CACHE_SIZE:
+                self.closures.popitem(last=False)
+
+        return [self.ids[n] for n in order]
+
+    def upstream(self, node_id, node_type=None):
+        """ ids of the nodes node_id depends on, only of node_type if given, ie File """
+
+        return [i for i in self.lineage(node_id) if node_type == None or self.node(i)[0] == node_type]
+
+    def downstream(self, node_id, node_type=None):
+        """ ids of the nodes that depend on node_id, only of node_type if given """
+
+        return [i for i in self.lineage(node_id, True) if node_type == None or self.node(i)[0] == node_type]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="sql_to_json.py lineage", description="Lists the upstream or downstream lineage of nodes in a DDG written by sql_to_json.py.")
+    parser.add_argument("ddg", help="Prov-JSON file, or sqlite or parquet output of sql_to_json.py")
+    parser.add_argument("nodes", nargs="+", help="node ids like d12, or names like out.csv for every node with that name")
+    parser.add_argument("--downstream", action="store_true", help="list what depends on the nodes (default: what they depend on)")
+    parser.add_argument("--informs", action="store_true", help="also follow wasInformedBy edges between consecutive steps")
+    parser.add_argument("--type", help="only list nodes of this type, ie File, Data or Operation")
+    args = parser.parse_args(argv)
+
+    index = LineageIndex(args.ddg, args.informs)
+
+    # one line per node: id, type and name, each node listed once
+    listed = set()
+    for name in args.nodes:
+        node_ids = index.find(name)
+        if len(node_ids) == 0:
+            parser.error("no node " + name + " in the DDG")
+        for node_id in node_ids:
+            if args.downstream:
+                lineage = index.downstream(node_id, args.type)
+            else:
+                lineage = index.upstream(node_id, args.type)
+            for i in lineage:
+                if i not in listed:
+                    listed.add(i)
+                    node_type, node_name = index.node(i)
+                    print("\t".join([i, str(node_type), str(node_name)]))
+
+if __name__ == "__main__":
+    main()
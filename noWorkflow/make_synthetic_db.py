@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import argparse
+
+# the noWorkflow tables and columns sql_to_json.py reads
+SCHEMA = """
+CREATE TABLE trial (id INTEGER PRIMARY KEY, script TEXT, start TEXT, finish TEXT, command TEXT);
+CREATE TABLE function_activation (id INTEGER PRIMARY KEY, trial_id INTEGER, name TEXT, line INTEGER,
+                                  return_value TEXT, start TEXT, finish TEXT, caller_id INTEGER);
+CREATE TABLE file_access (id INTEGER PRIMARY KEY, trial_id INTEGER, name TEXT, mode TEXT, content_hash_before TEXT,
+                          content_hash_after TEXT, timestamp TEXT, function_activation_id INTEGER);
+CREATE TABLE function_def (id INTEGER PRIMARY KEY, trial_id INTEGER, name TEXT, code_hash TEXT,
+                           first_line INTEGER, last_line INTEGER, docstring TEXT);
+CREATE TABLE object_value (id INTEGER PRIMARY KEY, trial_id INTEGER, function_activation_id INTEGER,
+                           name TEXT, value TEXT, type TEXT);
+"""
+
+# size knobs and their defaults
+DEFAULTS = {"activations": 10000, "functions": 10, "loops": 10, "file_accesses": 100,
+            "object_values": 1000, "snapshots": 10, "trials": 2}
+
+def make_trial(directory, trial_num, activations, functions, loops, file_accesses, snapshots):
+    """ writes the script of one trial and returns its lines, activations (name, line, return_value),
+    file accesses (name, mode, hash, index into activations) and function ends (name, last_line)
+    trial n reads the files trial n-1 wrote, so linked trials share file nodes """
+
+    script_name = os.path.join(directory, "script" + str(trial_num) + ".py")
+    lines, steps, files, func_ends = [], [], [], []
+    steps.append((script_name, 0, "None"))
+
+    # functions print their argument on their last line, so the print closes the function
+    for k in range (0, functions):
+        lines.append("def f%d(x):" % k)
+        lines.append("    print(x)")
+        func_ends.append(("f%d" % k, len(lines)))
+
+    reads = file_accesses // 2
+    writes = file_accesses - reads
+    for k in range (0, reads):
+        if trial_num == 1:
+            name, h = "/data/in%d.csv" % k, "in%d" % k
+        else:
+            name, h = "/results/out%d_%d.csv" % (trial_num-1, k), "out%d_%d" % (trial_num-1, k)
+        lines.append('with open("%s") as f:' % name[1:])
+        steps.append(("open", len(lines), "<file>"))
+        files.append((name, "r", h, len(steps)-1))
+        lines.append("    pass")
+
+    for k in range (0, snapshots):
+        lines.append('df%d = read_csv("data/in.csv")' % k)
+        steps.append(("read_csv", len(lines), "   Unnamed: 0  a  b\n0  0  %d  %d\n1  1  %d  %d" % (trial_num, k, k, trial_num)))
+
+    # the rest of the activations are split between the loops: a call and a print per iteration
+    if loops > 0:
+        remaining = activations - len(steps) - 2*loops - writes
+        iterations = max(remaining // (2*loops if functions > 0 else loops), 1)
+        for j in range (0, loops):
+            lines.append("for i in range(%d):" % iterations)
+            start = len(lines)
+            steps.append(("range", start, "range(0, %d)" % iterations))
+            if functions > 0:
+                name, last_line = func_ends[j % functions]
+                lines.append("    %s(i)" % name)
+                for i in range (0, iterations):
+                    steps.append((name, start+1, "None"))
+                    steps.append(("print", last_line, "None"))
+            else:
+                lines.append("    print(i)")
+                for i in range (0, iterations):
+                    steps.append(("print", start+1, "None"))
+            # first step after the loop closes it
+            lines.append("v%d = abs(%d)" % (j, j))
+            steps.append(("abs", len(lines), str(j)))
+
+    for k in range (0, writes):
+        name = "/results/out%d_%d.csv" % (trial_num, k)
+        lines.append('with open("%s", "w") as f:' % name[1:])
+        steps.append(("open", len(lines), "<file>"))
+        files.append((name, "w", "out%d_%d" % (trial_num, k), len(steps)-1))
+        lines.append("    pass")
+
+    while len(steps) < activations:
+        lines.append("print(%d)" % len(steps))
+        steps.append(("print", len(lines), "None"))
+
+    with open(script_name, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    return script_name, steps, files, func_ends
+
+def make_synthetic_db(directory, activations=DEFAULTS["activations"], functions=DEFAULTS["functions"],
+                      loops=DEFAULTS["loops"], file_accesses=DEFAULTS["file_accesses"],
+                      object_values=DEFAULTS["object_values"], snapshots=DEFAULTS["snapshots"],
+                      trials=DEFAULTS["trials"]):
+    """ makes directory/.noworkflow/db.sqlite and one script per trial, that sql_to_json.py can convert
+    activations, file accesses and object values are per trial
+    half of the object values match a return value, so they become used edges
+    returns the path of the database """
+
+    os.makedirs(os.path.join(directory, ".noworkflow"), exist_ok=True)
+    db_file = os.path.join(directory, ".noworkflow", "db.sqlite")
+    if os.path.exists(db_file):
+        os.remove(db_file)
+
+    db = sqlite3.connect(db_file)
+    db.executescript(SCHEMA)
+
+    activation_id = 0
+    for trial_num in range (1, trials+1):
+        script_name, steps, files, func_ends = make_trial(os.path.abspath(directory), trial_num, activations, functions, loops, file_accesses, snapshots)
+        first_id = activation_id + 1
+
+        db.execute('INSERT INTO trial (id, script, start, finish, command) VALUES (?, ?, ?, ?, ?)',
+                   (trial_num, script_name, "2020-01-01 00:00:%02d" % (trial_num % 60), "2020-01-01 00:01:%02d" % (trial_num % 60), "python " + script_name))
+        db.executemany('INSERT INTO function_activation (id, trial_id, name, line, return_value) VALUES (?, ?, ?, ?, ?)',
+                       [(first_id + i, trial_num, steps[i][0], steps[i][1], steps[i][2]) for i in range (0, len(steps))])
+        db.executemany('INSERT INTO file_access (trial_id, name, mode, content_hash_after, function_activation_id) VALUES (?, ?, ?, ?, ?)',
+                       [(trial_num, f[0], f[1], f[2], first_id + f[3]) for f in files])
+        db.executemany('INSERT INTO function_def (trial_id, name, last_line) VALUES (?, ?, ?)',
+                       [(trial_num, f[0], f[1]) for f in func_ends])
+
+        # arguments of later steps, every other one the return value of an abs after a loop
+        values = []
+        for i in range (0, object_values):
+            step = first_id + 1 + (i * 7919) % (len(steps)-1)
+            value = str(i % max(loops, 1)) if i % 2 == 0 else "x" + str(i)
+            values.append((trial_num, step, "x", value, "int"))
+        db.executemany('INSERT INTO object_value (trial_id, function_activation_id, name, value, type) VALUES (?, ?, ?, ?, ?)', values)
+
+        activation_id += len(steps)
+
+    db.commit()
+    db.close()
+
+    return db_file
+
+def main():
+    parser = argparse.ArgumentParser(description="Makes a synthetic noWorkflow database and scripts for benchmarking sql_to_json.py.")
+    parser.add_argument("directory", help="where the scripts and .noworkflow/db.sqlite are made")
+    for knob in DEFAULTS:
+        parser.add_argument("--" + knob.replace("_", "-"), type=int, default=DEFAULTS[knob])
+    args = parser.parse_args()
+
+    knobs = {}
+    for knob in DEFAULTS:
+        knobs[knob] = getattr(args, knob)
+    print(make_synthetic_db(args.directory, **knobs))
+
+if __name__ == "__main__":
+    main()
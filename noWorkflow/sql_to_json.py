@@ -1,39 +1,353 @@
 import sqlite3
 import json
 import ast
-import pandas
 import os
+import csv
+import gzip
+import sys
+import time
+import zlib
+import pickle
+import fnmatch
+import argparse
+import functools
+import contextlib
+import shutil
+import hashlib
+import array
+import tempfile
+import threading
+import queue
+import urllib.request
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+
+# queries used during conversion. kept in one place so every trial reuses
+# the same prepared statements on the shared connection, and so that
+# explain_queries can report their query plans
+QUERIES = {
+    "script_name": 'SELECT id, command from trial where id = ?',
+    "trial_finish": 'SELECT finish from trial where id = ?',
+    "trials": 'SELECT id, command from trial order by id',
+    "new_trials": 'SELECT id, command, finish from trial where id > ? order by id',
+    "script_steps": 'SELECT a.trial_id, a.id, a.name, a.return_value, a.line, f.name, f.mode, f.content_hash_after '
+                    'from function_activation a left join file_access f on f.function_activation_id = a.id and f.trial_id = a.trial_id '
+                    'where a.trial_id = ? order by a.id, f.id',
+    "returns": 'SELECT name, count(*) from function_activation where trial_id = ? and '
+               '(return_value is null or return_value != \'None\') group by name',
+    "func_ends": 'SELECT name, trial_id, last_line from function_def where trial_id = ?',
+    "arguments": 'SELECT value, function_activation_id from object_value where trial_id = ? and value in '
+                 '(SELECT return_value from function_activation where trial_id = ? and '
+                 'return_value is not null and return_value != \'None\') order by id',
+}
+
+# tables copied into the optional side-car database, with the covering indexes their queries need
+SIDECAR_INDEXES = {
+    "function_activation": 'CREATE INDEX function_activation_trial_name on function_activation (trial_id, name, return_value)',
+    "file_access": 'CREATE INDEX file_access_trial_activation on file_access (trial_id, function_activation_id)',
+    "object_value": 'CREATE INDEX object_value_trial_value on object_value (trial_id, value, function_activation_id)',
+}
+
+# pragmas for the read-only connection: 256MB memory map, 64MB page cache
+DB_PRAGMAS = ["PRAGMA mmap_size = 268435456", "PRAGMA cache_size = -65536"]
+
+# function activations fetched from the database at a time
+FETCH_BATCH = 1000
+
+# federated mode: trials each database's thread may extract ahead of the merge
+FEDERATED_QUEUE = 4
+
+# watch mode: seconds between polls of the database, seconds a finished trial waits
+# so the trials finished meanwhile are converted with it, most trials converted between writes of the output,
+# and most finished trials waiting to be converted, the others are read from the database later
+WATCH_POLL = 1.0
+WATCH_DEBOUNCE = 2.0
+WATCH_MAX_BATCH = 16
+WATCH_MAX_PENDING = 256
+
+# number of parsed scripts kept in memory, shared by all trials in a run
+# and by the threads of federated mode and ddg_diff, so it is only used under script_lock
+SCRIPT_CACHE_SIZE = 32
+script_cache = OrderedDict()
+script_lock = threading.Lock()
+
+# wall time spent in each phase of the conversion, reported by --stats
+# time in a nested phase is not counted in the phase around it
+phase_times = OrderedDict()
+phase_lock = threading.Lock()
+
+# each thread times its own nested phases, ie the databases of federated mode
+phase_local = threading.local()
+
+# registered ProfileHooks, notified of timed phases, profiled calls and counters
+profile_hooks = []
+
+class ProfileHook:
+    """ base for profiling hooks, registered with add_profile_hook.
+    start and end are called around every timed phase, and around every call of a
+    profiled function while a hook is registered. own_seconds leaves out nested phases.
+    count is called with counters, ie file accesses or dependency edges """
+
+    def start(self, name):
+        pass
+
+    def end(self, name, seconds, own_seconds):
+        pass
+
+    def count(self, name, n):
+        pass
+
+class ProfileSummary(ProfileHook):
+    """ hook that adds up calls, own time and counters, used by --profile """
+
+    def __init__(self):
+        self.calls = OrderedDict()
+        self.seconds = OrderedDict()
+        self.counters = OrderedDict()
+        # phases end on several threads in federated mode
+        self.lock = threading.Lock()
+
+    def end(self, name, seconds, own_seconds):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + own_seconds
+
+    def count(self, name, n):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        lines = ["%-24s %10s %10s" % ("function or phase", "calls", "seconds")]
+        for name in self.calls:
+            lines.append("%-24s %10d %10.3f" % (name, self.calls[name], self.seconds[name]))
+        for name in self.counters:
+            lines.append("%-24s %10d" % (name, self.counters[name]))
+        return "\n".join(lines)
+
+def add_profile_hook(hook):
+    profile_hooks.append(hook)
+
+def remove_profile_hook(hook):
+    profile_hooks.remove(hook)
+
+def count(name, n=1):
+    """ passes a counter to the registered hooks """
+
+    for hook in profile_hooks:
+        hook.count(name, n)
+
+@contextlib.contextmanager
+def timed(phase, record=True):
+    """ adds the time spent in the with block to phase_times[phase]
+    record=False only tells the hooks, ie for profiled functions, so --stats keeps its phases """
+
+    for hook in profile_hooks:
+        hook.start(phase)
+
+    if not hasattr(phase_local, "stack"):
+        phase_local.stack = []
+    phase_stack = phase_local.stack
+
+    # time in the nested phases, and in every nested block for the hooks
+    start = time.perf_counter()
+    phase_stack.append([0.0, 0.0])
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested, nested_blocks = phase_stack.pop()
+        if record:
+            with phase_lock:
+                phase_times[phase] = phase_times.get(phase, 0.0) + elapsed - nested
+        if len(phase_stack) > 0:
+            # a block that is not recorded is part of the phase around it, only its nested phases are not
+            phase_stack[-1][0] += elapsed if record else nested
+            phase_stack[-1][1] += elapsed
+
+        for hook in profile_hooks:
+            hook.end(phase, elapsed, elapsed - nested_blocks)
+
+def profiled(function):
+    """ times every call of function for the hooks, only while a hook is registered
+    the calls are not phases in phase_times """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if len(profile_hooks) == 0:
+            return function(*args, **kwargs)
+        with timed(function.__name__, record=False):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+def get_script_info(script_name):
+    """ reads and parses a script once, keeping its lines for O(1) lookup
+    cached by path and modification time so trials that share a script reuse it """
+
+    key = (os.path.abspath(script_name), os.path.getmtime(script_name))
+    with script_lock:
+        if key in script_cache:
+            script_cache.move_to_end(key)
+            return script_cache[key]
+
+    # parsed outside the lock, so other threads are not held up
+    with open(script_name) as f:
+        lines = f.readlines()
+
+    script_info = {"lines": lines, "tree": ast.parse("".join(lines))}
+
+    with script_lock:
+        # another thread may have parsed it meanwhile, its copy is kept so the scope index is shared
+        if key in script_cache:
+            script_cache.move_to_end(key)
+            return script_cache[key]
+
+        # evict the least recently used script
+        script_cache[key] = script_info
+        if len(script_cache) > SCRIPT_CACHE_SIZE:
+            script_cache.popitem(last=False)
+
+    return script_info
+
+def get_line(script_info, line_num):
+    """ returns line line_num of the script (numbered from 1), or "" if out of range """
+
+    if line_num is None or line_num < 1 or line_num > len(script_info["lines"]):
+        return ""
+    return script_info["lines"][line_num-1]
+
+def db_uri(db_file, options="mode=ro&immutable=1"):
+    """ makes a sqlite uri for db_file, which may already be a file: uri """
+
+    if db_file.startswith("file:"):
+        separator = "&" if "?" in db_file else "?"
+        return db_file + separator + options
+    return "file:" + urllib.request.pathname2url(os.path.abspath(db_file)) + "?" + options
+
+def build_index_db(input_db_file, index_db_file):
+    """ copies the queried tables into a side-car database and indexes them there,
+    so the noWorkflow database itself is never modified.
+    only rebuilt when the noWorkflow database has changed since the last build """
+
+    stat = os.stat(input_db_file)
+    source = (os.path.abspath(input_db_file), stat.st_mtime, stat.st_size)
+
+    if os.path.exists(index_db_file):
+        idx = sqlite3.connect(index_db_file)
+        try:
+            built_from = idx.execute('SELECT path, mtime, size from sidecar_source').fetchone()
+        except sqlite3.DatabaseError:
+            built_from = None
+        idx.close()
+        if built_from == source:
+            return
+        os.remove(index_db_file)
+
+    idx = sqlite3.connect(index_db_file)
+    idx.execute('ATTACH DATABASE ? AS source', (db_uri(input_db_file), ))
+
+    # same schema as the original so ids stay integer primary keys
+    for table in SIDECAR_INDEXES:
+        create_table = idx.execute("SELECT sql from source.sqlite_master where type = 'table' and name = ?", (table, )).fetchone()[0]
+        idx.execute(create_table)
+        idx.execute('INSERT INTO main.' + table + ' SELECT * from source.' + table)
+        idx.execute(SIDECAR_INDEXES[table])
+
+    idx.execute('CREATE TABLE sidecar_source (path, mtime, size)')
+    idx.execute('INSERT INTO sidecar_source VALUES (?, ?, ?)', source)
+    idx.commit()
+    idx.close()
+
+def open_db(input_db_file, index_db_file=None, live=False):
+    """ opens one read-only connection to the noWorkflow database, shared by every trial in a run
+    if index_db_file is given, the indexed side-car copy is opened as the main database
+    and the noWorkflow database is attached, so its indexed tables are found first
+    live: noWorkflow may still be writing to the database, so it is not opened as immutable
+    a database with changes still in its write-ahead log is opened as live too, immutable would miss them """
+
+    wal_file = input_db_file + "-wal"
+    if not input_db_file.startswith("file:") and os.path.exists(wal_file) and os.path.getsize(wal_file) > 0:
+        live = True
+
+    options = "mode=ro" if live else "mode=ro&immutable=1"
+    if index_db_file:
+        build_index_db(input_db_file, index_db_file)
+        db = sqlite3.connect(db_uri(index_db_file, "mode=ro"), uri=True)
+        db.execute('ATTACH DATABASE ? AS source', (db_uri(input_db_file, options), ))
+    else:
+        db = sqlite3.connect(db_uri(input_db_file, options), uri=True)
 
-def get_info_from_sql(input_db_file, run_num):
-    """ queries noWorkflow sql database """
+    for pragma in DB_PRAGMAS:
+        db.execute(pragma)
 
-    db = sqlite3.connect(input_db_file, uri=True)
-    c = db.cursor()
+    return db
 
-    # script_name
-    c.execute('SELECT id, command from trial where id = ?', (run_num, ))
-    temp = c.fetchone()
+def explain_queries(db, run_num):
+    """ returns the EXPLAIN QUERY PLAN output of every conversion query as a printable report """
+
+    report = []
+    for name, query in QUERIES.items():
+        report.append(name + ": " + query)
+        # any value works for the parameters, the plan does not depend on them
+        for row in db.execute('EXPLAIN QUERY PLAN ' + query, (run_num, ) * query.count("?")):
+            report.append("    " + row[-1])
+
+    return "\n".join(report)
+
+def get_script_name(db, run_num):
+    """ gets the script of a trial from the command it was run with """
+
+    temp = db.execute(QUERIES["script_name"], (run_num, )).fetchone()
     temp = temp[1]
     temp = temp.split(" ")
-    script_name = temp[1]
+    return temp[1]
 
-    # process nodes
-    c.execute('SELECT trial_id, id, name, return_value, line from function_activation where trial_id = ?', (run_num,))
-    script_steps = c.fetchall()
+def get_script_steps(db, run_num):
+    """ yields (step, file access) for each function activation of the trial, in id order
+    step is (trial_id, id, name, return_value, line), the file access a dict of name, mode and hash, or None
+    rows are fetched FETCH_BATCH at a time with their file accesses joined in,
+    so the activations of a trial are never all in memory """
 
-    # file io nodes
-    c.execute('SELECT trial_id, name, function_activation_id, mode, content_hash_after from file_access where trial_id = ?' , (run_num, ))
-    files = c.fetchall()
+    c = db.cursor()
+    with timed("SQL fetch"):
+        c.execute(QUERIES["script_steps"], (run_num, ))
+
+    # an activation is only yielded once the next one is seen, since it can have several file accesses
+    # the last one is kept
+    step, file_access = None, None
+    while True:
+        with timed("SQL fetch"):
+            rows = c.fetchmany(FETCH_BATCH)
+        if len(rows) == 0:
+            break
+        for row in rows:
+            if step != None and row[1] != step[1]:
+                yield step, file_access
+                file_access = None
+            step = row[:5]
+            if row[5] != None:
+                file_access = {"name": row[5], "mode": row[6], "hash": row[7]}
+
+    if step != None:
+        yield step, file_access
 
-    # dict for easier access to file info
-    temp = {}
-    for f in files:
-        d = {"name": f[1], "mode": f[3], "hash" : f[4]}
-        temp[f[2]] = d
-    files = temp
+    c.close()
+
+def get_info_from_sql(db, run_num):
+    """ queries noWorkflow sql database
+    the steps are returned as a get_script_steps iterator, read while the graph is built """
+
+    c = db.cursor()
+
+    # script_name
+    script_name = get_script_name(db, run_num)
+
+    # process nodes and file io nodes
+    script_steps = get_script_steps(db, run_num)
 
     # functions
-    c.execute('SELECT name, trial_id, last_line from function_def where trial_id = ?', (run_num, ))
+    c.execute(QUERIES["func_ends"], (run_num, ))
     func_ends = c.fetchall()
 
     # dict for easier access to func_ends. used for collapsing nodes
@@ -44,37 +358,284 @@ def get_info_from_sql(input_db_file, run_num):
         end_funcs[f[2]] = f[0]
     func_ends = temp
 
+    # count the calls of each function that have a return value
+    c.execute(QUERIES["returns"], (run_num, ))
+    returns = dict(c.fetchall())
+
     # if f has return value, f[2]-=1
     # so last line detected correctly
     # last line informs the finish node + allows for sequential functions
     for f in func_ends:
-        c.execute('SELECT trial_id, name, return_value from function_activation where trial_id = ? and name = ?', (run_num, f, ))
-        calls = c.fetchall()
-        for call in calls:
-            if call[2]!="None":
-                func_ends[f]-=1
-                temp = func_ends[f]
-                end_funcs[temp]=f
+        for i in range (0, returns.get(f, 0)):
+            func_ends[f]-=1
+            temp = func_ends[f]
+            end_funcs[temp]=f
 
     c.close()
 
-    return script_steps, files, func_ends, end_funcs, script_name
+    return script_steps, func_ends, end_funcs, script_name
+
+# snapshot file formats and their extensions
+SNAPSHOT_FORMATS = {"csv": ".csv", "csv.gz": ".csv.gz", "parquet": ".parquet", "feather": ".feather"}
+
+# threads writing snapshots, and the most writes that can be waiting for them
+SNAPSHOT_THREADS = 4
+SNAPSHOT_QUEUE = 64
+
+# size of the distinct return values each SnapshotWriter shares between data nodes, least recently used dropped past it
+VALUE_CACHE_BYTES = 64 * 1024 * 1024
+
+# return values up to this length are matched to arguments as they are, longer ones by their sha1
+VALUE_KEY_MAX = 64
 
-def get_defaults(script_name):
+# converted trials kept in the cache directory, bumped when the cached format changes
+TRIAL_CACHE_VERSION = 1
+TRIAL_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# sections of the Prov-JSON file, in the order they are written, and the prefix of their ids
+SECTIONS = ["activity", "entity", "wasInformedBy", "wasGeneratedBy", "used"]
+SECTION_PREFIXES = {"activity": "p", "entity": "d", "wasInformedBy": "e", "wasGeneratedBy": "e", "used": "e"}
+
+# output formats picked from the output file's extension, Prov-JSON for any other
+OUTPUT_FORMATS = {".sqlite": "sqlite", ".db": "sqlite", ".parquet": "parquet"}
+
+# compression of Prov-JSON files, picked from the extension
+OUTPUT_COMPRESSIONS = {".gz": "gzip", ".zst": "zstd"}
+
+# json modules tried in order when the json backend is 'auto'
+JSON_BACKENDS = ["orjson", "ujson", "json"]
+
+# edge columns indexed in sqlite output, so lineage queries do not scan the edge tables
+TABLE_INDEXES = {"wasInformedBy": ["prov:informant", "prov:informed"],
+                 "wasGeneratedBy": ["prov:activity", "prov:entity"],
+                 "used": ["prov:activity", "prov:entity"]}
+
+# nodes or edges written to sqlite or parquet tables at a time
+TABLE_BATCH = 10000
+
+# attribute names of the nodes and edges in CompactSections, each set stored once
+schemas = []
+schema_ids = {}
+
+# values up to this long are interned, so repeated names, lines and ids are stored once
+INTERN_MAX_LENGTH = 32
+
+def to_json_default(temp):
+    """ fallback for values the json module cannot serialise, ie pandas objects """
+    return json.loads(temp.to_json())
+
+json_dumps = functools.partial(json.dumps, default=to_json_default)
+
+def get_json_dumps(backend="auto"):
+    """ returns a function serialising one value to a JSON string
+    backend: json (same output as json.dump), orjson, ujson, or auto for the first of them installed
+    orjson and ujson write compact JSON with unicode unescaped: the same data in fewer bytes """
+
+    if backend == "auto":
+        for name in JSON_BACKENDS:
+            try:
+                return get_json_dumps(name)
+            except ImportError:
+                pass
+
+    if backend == "orjson":
+        import orjson
+        return lambda value: orjson.dumps(value, default=to_json_default).decode()
+    elif backend == "ujson":
+        import ujson
+        return lambda value: ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False, default=to_json_default)
+    elif backend == "json":
+        return json_dumps
+
+    raise ValueError("unknown json backend: " + backend)
+
+class SpillSection:
+    """ stands in for one section of the result dict when streaming output.
+    each node or edge is serialised to a temporary file as soon as it is added,
+    so the graph is never fully held in memory """
+
+    def __init__(self, dumps=None):
+        self.file = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        self.dumps = dumps or get_json_dumps("json")
+        self.count = 0
+
+    def __setitem__(self, key, value):
+        # one per line, JSON strings never hold a raw newline
+        self.file.write(self.dumps(key) + ": " + self.dumps(value) + "\n")
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        """ reads back the spilled (id, node or edge dict), in the order they were added """
+
+        self.file.seek(0)
+        for line in self.file:
+            yield from json.loads("{" + line + "}").items()
+        self.file.seek(0, os.SEEK_END)
+
+    def write(self, outfile):
+        """ copies the spilled nodes or edges to outfile with the same separators as json.dump
+        more can be added after, ie in watch mode """
+
+        self.file.seek(0)
+        first = True
+        for line in self.file:
+            if not first:
+                outfile.write(", ")
+            outfile.write(line[:-1])
+            first = False
+        self.file.seek(0, os.SEEK_END)
+
+def intern_schema(keys):
+    """ returns the id of a tuple of attribute names, adding it to schemas if new """
+
+    if keys not in schema_ids:
+        schema_ids[keys] = len(schemas)
+        schemas.append(keys)
+    return schema_ids[keys]
+
+class CompactSection:
+    """ holds one section of the result in little memory. each node or edge is kept
+    as a tuple of its values, with its attribute names interned as a shared schema,
+    and its id as a number after the section's prefix. turned back into Prov-JSON
+    only when written, so add_start_node, add_process, add_end_node etc. are unchanged """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.ids = array.array('q')
+        self.schemas = array.array('L')
+        self.records = []
+        # position -> id, for ids that are not the prefix and a number, ie environment
+        self.other_keys = {}
+
+    def __setitem__(self, key, value):
+        number = key[len(self.prefix):]
+        if key.startswith(self.prefix) and number.isascii() and number.isdigit() and number[0] != "0":
+            self.ids.append(int(number))
+        else:
+            self.other_keys[len(self.records)] = key
+            self.ids.append(-1)
+        self.schemas.append(intern_schema(tuple(value)))
+        # short values repeat (names, lines, ids in edges), so keep one copy of each
+        intern = sys.intern
+        self.records.append(tuple([intern(v) if type(v) is str and len(v) <= INTERN_MAX_LENGTH else v for v in value.values()]))
+
+    def __len__(self):
+        return len(self.records)
+
+    def key(self, i):
+        if self.ids[i] == -1:
+            return self.other_keys[i]
+        return self.prefix + str(self.ids[i])
+
+    def items(self):
+        """ yields (id, node or edge dict) in the order they were added """
+
+        for i in range (0, len(self.records)):
+            yield self.key(i), dict(zip(schemas[self.schemas[i]], self.records[i]))
+
+    def write(self, outfile, dumps=None):
+        """ writes the nodes or edges to outfile as the inside of a Prov-JSON section
+        with dumps from get_json_dumps, or without it in the same format as json.dump,
+        encoding the values one by one rather than rebuilding the dicts """
+
+        if dumps != None and dumps != json_dumps:
+            # TABLE_BATCH records at a time, as one object with its braces cut off
+            for start in range (0, len(self.records), TABLE_BATCH):
+                batch = {}
+                for i in range (start, min(start + TABLE_BATCH, len(self.records))):
+                    batch[self.key(i)] = dict(zip(schemas[self.schemas[i]], self.records[i]))
+                if start > 0:
+                    outfile.write(", ")
+                outfile.write(dumps(batch)[1:-1])
+            return
+
+        encode = json.JSONEncoder(default=to_json_default).encode
+        encode_string = json.encoder.encode_basestring_ascii
+        encoded_names = {}
+
+        for i in range (0, len(self.records)):
+            schema_id = self.schemas[i]
+            if schema_id not in encoded_names:
+                encoded_names[schema_id] = [encode(name) + ": " for name in schemas[schema_id]]
+            names = encoded_names[schema_id]
+
+            parts = []
+            j = 0
+            for value in self.records[i]:
+                if type(value) is str:
+                    parts.append(names[j] + encode_string(value))
+                else:
+                    parts.append(names[j] + encode(value))
+                j += 1
+
+            if i > 0:
+                outfile.write(", ")
+            outfile.write(encode_string(self.key(i)) + ": {" + ", ".join(parts) + "}")
+
+def get_compact_result():
+    """ makes an empty result whose sections are CompactSections """
+
+    result = {}
+    for key in SECTIONS:
+        result[key] = CompactSection(SECTION_PREFIXES[key])
+
+    return result
+
+class RecordingSection:
+    """ stands in for one section of the result dict in parallel mode.
+    records each node or edge, in the order they are made, in a list shared
+    by all sections so merge_trial can renumber them into the linked result """
+
+    def __init__(self, name, events):
+        self.name = name
+        self.events = events
+        self.count = 0
+
+    def __setitem__(self, key, value):
+        self.events.append((self.name, key, value))
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+def get_recording_result():
+    """ makes an empty result whose sections record into one shared event list """
+
+    result, events = {}, []
+    for key in SECTIONS:
+        result[key] = RecordingSection(key, events)
+
+    return result
+
+def get_spill_result(dumps=None):
+    """ makes an empty result whose sections spill to temporary files, serialised with dumps """
+
+    result = {}
+    for key in SECTIONS:
+        result[key] = SpillSection(dumps)
+
+    return result
+
+def get_defaults(script_name, result=None):
     """ sets default required fields for the Prov-JSON file, ie environment node
     variable 'rdt:script' is the first script in the workflow.
+    result may already hold empty sections, ie from get_spill_result
     """
-    result, activity_d, environment_d = {}, {}, {}
+    if result is None:
+        result = {}
+    environment_d = {}
 
     environment_d['rdt:language'] = "R"
     environment_d["rdt:script"] = script_name
-    activity_d['environment'] = environment_d
 
-    result['activity']= activity_d
+    for key in SECTIONS:
+        if key not in result:
+            result[key] = {}
 
-    keys = ["entity", "wasInformedBy", "wasGeneratedBy", "used"]
-    for i in range (0, len(keys)):
-        result[keys[i]]={}
+    result['activity']['environment'] = environment_d
 
     return result
 
@@ -220,49 +781,303 @@ def add_file_edge(current_p, dkey_string, e_count, current_link_dict, result, ac
         result['used'][e_string] = current_edge_node
     else:
         result['wasGeneratedBy'][e_string] = current_edge_node
-        # if file created, add to outfiles dict for linking graphs
-        inner_dict = {'data_node_num': dkey_string, 'source': activation_id_to_p_string[s[1]], 'hash_out': h}
-        outer_dict = {path_array[-1] : inner_dict}
-        outfiles[first_step[2]] = outer_dict
+        # if file created, add to outfiles index for linking graphs
+        # keyed by name and hash, with every process that produced it
+        key = (path_array[-1], h)
+        if key not in outfiles:
+            outfiles[key] = {'data_node_num': dkey_string, 'hash_out': h, 'producers': []}
+        outfiles[key]['producers'].append({'script': first_step[2], 'source': activation_id_to_p_string[s[1]]})
 
-def add_file(result, files, d_count, e_count, current_p, s, outfiles, first_step, activation_id_to_p_string, data_dict):
-    """ uses files dict to add file nodes and access edges to the dictionary
-    uses outfiles dict to check if file already exists from a previous script """
+    return e_count
 
-    dkey_string = -1
+@profiled
+def add_file(result, file_access, d_count, e_count, current_p, s, outfiles, first_step, activation_id_to_p_string, data_dict):
+    """ uses the file access of step s to add file nodes and access edges to the dictionary
+    uses outfiles, an index of the files written so far keyed by (name, hash),
+    to check if file already exists from this or a previous script """
 
     # get file_name
-    current_link_dict = files[s[1]]
+    current_link_dict = file_access
     path_array = current_link_dict['name'].split("/")
 
     #get hash
-    file_entry = files[s[1]]
-    h = file_entry['hash']
-
-    if len(outfiles.keys()) !=0:
-    # if not first script, check to see if the file already has a node using name and hash
-        for script in outfiles.keys():
-                for outfile in outfiles[script]:
-                    # if already seen
-                    if outfile == path_array[-1] and outfiles[script][outfile]['hash_out']==h:
-                        # do not add new node, but return d_key_string
-                        dkey_string = data_dict[path_array[-1]]
-
-        if dkey_string == -1: # if not seen yet, add node
-            d_count, dkey_string = add_file_node(path_array[-1], current_link_dict, d_count, result, data_dict)
-        # add new dependent edge
-        add_file_edge(current_p, dkey_string, e_count, current_link_dict, result, activation_id_to_p_string, s, h, path_array, first_step, outfiles)
-
-    # if first script, add file nodes w/o checking prior existence
+    h = current_link_dict['hash']
+
+    # if already produced with the same contents, do not add new node, but use its d_key_string
+    if (path_array[-1], h) in outfiles:
+        dkey_string = outfiles[(path_array[-1], h)]['data_node_num']
+        data_dict[path_array[-1]] = dkey_string
+        count("file nodes reused")
     else:
         d_count, dkey_string = add_file_node(path_array[-1], current_link_dict, d_count, result, data_dict)
-        add_file_edge(current_p, dkey_string, e_count, current_link_dict, result, activation_id_to_p_string, s, h, path_array, first_step, outfiles)
+
+    # add new dependent edge
+    e_count = add_file_edge(current_p, dkey_string, e_count, current_link_dict, result, activation_id_to_p_string, s, h, path_array, first_step, outfiles)
 
     return d_count, e_count
 
-def add_data_edge(result, s, d_count, e_count, current_p, script_name):
+def get_snapshot_format(fmt):
+    """ picks the snapshot file format
+    'compact', 'parquet' and 'feather' need pyarrow, without it gzip csv is used """
+
+    if fmt not in SNAPSHOT_FORMATS and fmt != "compact":
+        raise ValueError("unknown snapshot format: " + fmt)
+
+    if fmt in ("compact", "parquet", "feather"):
+        try:
+            import pyarrow
+        except ImportError:
+            return "csv.gz"
+        if fmt == "compact":
+            return "parquet"
+
+    return fmt
+
+def parse_return_value(value):
+    """ recognises return values that are printed dataframes, without using pandas
+    returns (column names, rows) for an entire dataframe or a subset of one
+    or None for an integer value or different type of return statement """
+
+    # -------STRING FORMATTING FOR PRINTING---------
+    # Cases to test:
+    # full df
+    # full labeled df
+    # labelled subset
+    # unlabelled subset
+    # labelled subset len >1
+    # unlabelled subset len >1
+    # Check all if statements with more script examples
+
+    if value == None:
+        return None
+
+    y = value.split("\n")
+
+    # use first line and last line to figure out formatting
+    first_line = y[0].strip()
+    last_line = y[-1].strip()
+
+    if "Unnamed:" in first_line: # entire dataframe
+        col_names = first_line.split()[1:]
+        lines = y[1:]
+
+    elif "Name:" in last_line: # subset of dataframe
+        col_names = []
+        temp = last_line.split()
+        for i in range (1, int(len(temp)/2), 2):
+            col_names.append(temp[i].strip(","))
+        lines = y[:-1]
+
+    else:
+        return None
+
+    # drop the index column, short rows are padded like pandas would
+    rows = []
+    for l in lines:
+        line = l.split()[1:]
+        if len(line) > len(col_names): # not a table after all
+            return None
+        rows.append(line + [""] * (len(col_names) - len(line)))
+
+    return col_names, rows
+
+def value_key(value):
+    """ what a return value is matched to arguments by: short values themselves, long ones their sha1 digest """
+
+    if len(value) <= VALUE_KEY_MAX:
+        return value
+    return hashlib.sha1(value.encode()).digest()
+
+def over_bytes(value, max_bytes):
+    """ whether value is longer than max_bytes once utf-8 encoded, a character being 1 to 4 bytes
+    it is only encoded when its length in characters cannot tell """
+
+    if len(value) > max_bytes:
+        return True
+    if 4 * len(value) <= max_bytes:
+        return False
+    return len(value.encode()) > max_bytes
+
+def write_once(write, path, *args):
+    """ runs write(path, *args) on the SnapshotWriter's threads, through atomic_path
+    files are named by content, so one that already exists is not rewritten """
+
+    if os.path.exists(path):
+        return
+
+    with atomic_path(path) as temp_path:
+        write(temp_path, *args)
+
+def write_value(path, value):
+    """ writes the full text of a long return value """
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(value)
+
+def write_snapshot(path, table, fmt):
+    """ writes one snapshot
+    csv rows are written straight to the file, pandas is only imported for parquet and feather """
+
+    col_names, rows = table
+
+    if fmt in ("parquet", "feather"):
+        import pandas
+        df = pandas.DataFrame(rows, columns = col_names)
+        if fmt == "parquet":
+            df.to_parquet(path)
+        else:
+            df.to_feather(path)
+    else:
+        if fmt == "csv.gz":
+            outfile = gzip.open(path, "wt", newline="")
+        else:
+            outfile = open(path, "w", newline="")
+        # same layout as pandas to_csv: unnamed index column, then the values
+        with outfile:
+            writer = csv.writer(outfile, lineterminator=os.linesep)
+            writer.writerow([""] + col_names)
+            for i in range (0, len(rows)):
+                writer.writerow([i] + rows[i])
+
+class SnapshotWriter:
+    """ writes dataframe return values to snapshot files on a background thread pool
+    root: directory the per-script snapshot directories are made in, or None to keep dataframes as data nodes
+    relative_to: directory of the Prov-JSON file, snapshot paths in the nodes are relative to it
+    fmt: one of SNAPSHOT_FORMATS or 'compact'
+    max_bytes: return values longer than this, in utf-8 bytes, are not written
+    also keeps the other return values of data nodes, see add_value:
+    value_max_bytes: values longer than this, in utf-8 bytes, are replaced by a preview with their sha1 and length
+    value_dir: where the full text of those values is written, by default it is not kept """
+
+    def __init__(self, root, relative_to, fmt="csv", max_bytes=None, value_max_bytes=None, value_dir=None):
+        self.root = root
+        self.relative_to = relative_to
+        self.format = get_snapshot_format(fmt)
+        self.max_bytes = max_bytes
+        self.value_max_bytes = value_max_bytes
+        self.value_dir = value_dir
+        self.values = OrderedDict()
+        self.values_bytes = 0
+        self.directories = set()
+        self.written = set()
+        self.errors = []
+        self.pending = threading.BoundedSemaphore(SNAPSHOT_QUEUE)
+        self.executor = ThreadPoolExecutor(max_workers=SNAPSHOT_THREADS)
+
+    def add(self, table, value, script_name):
+        """ queues a snapshot of table, from parse_return_value, where value is the return value it was parsed from
+        returns the path for the data node, or None if the snapshot is too large """
+
+        with timed("snapshots"):
+            return self.queue(table, value, script_name)
+
+    def queue(self, table, value, script_name):
+        if self.max_bytes != None and over_bytes(value, self.max_bytes):
+            count("snapshots skipped")
+            return None
+
+        # one directory per script, made the first time it is needed
+        script = os.path.splitext(os.path.basename(script_name))[0]
+        directory = os.path.join(self.root, "intermediate_values_of_" + script + "_data")
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+
+        # identical snapshots share one file
+        digest = hashlib.sha1(value.encode()).hexdigest()[:16]
+        path = os.path.join(directory, "data-" + digest + SNAPSHOT_FORMATS[self.format])
+        if path in self.written:
+            count("snapshots reused")
+        else:
+            count("snapshots written")
+            self.written.add(path)
+            # blocks while the queue is full
+            self.pending.acquire()
+            future = self.executor.submit(write_once, write_snapshot, path, table, self.format)
+            future.add_done_callback(self.done)
+
+        return os.path.relpath(path, self.relative_to)
+
+    def add_value(self, value):
+        """ the rdt:value of a data node for return value value
+        identical values share one string, long ones become a preview, written to value_dir if given """
+
+        key = value_key(value)
+        if key in self.values:
+            self.values.move_to_end(key)
+            count("values shared")
+            return self.values[key]
+
+        stored = value
+        if self.value_max_bytes != None and over_bytes(value, self.value_max_bytes):
+            with timed("snapshots"):
+                stored = self.preview(value)
+
+        # evict the least recently used values
+        self.values[key] = stored
+        self.values_bytes += len(stored)
+        while self.values_bytes > VALUE_CACHE_BYTES and len(self.values) > 1:
+            self.values_bytes -= len(self.values.popitem(last=False)[1])
+
+        return stored
+
+    def preview(self, value):
+        encoded = value.encode()
+        digest = hashlib.sha1(encoded).hexdigest()
+        # cut on a character boundary, the bytes of a character split by the cut are dropped
+        stored = encoded[:self.value_max_bytes].decode(errors="ignore") + "... (" + str(len(encoded)) + " bytes, sha1 " + digest
+        count("values truncated")
+
+        if self.value_dir != None:
+            if self.value_dir not in self.directories:
+                os.makedirs(self.value_dir, exist_ok=True)
+                self.directories.add(self.value_dir)
+            path = os.path.join(self.value_dir, "value-" + digest + ".txt")
+            if path not in self.written:
+                self.written.add(path)
+                self.pending.acquire()
+                future = self.executor.submit(write_once, write_value, path, value)
+                future.add_done_callback(self.done)
+            stored += ", in " + os.path.relpath(path, self.relative_to)
+
+        return stored + ")"
+
+    def done(self, future):
+        self.pending.release()
+        if future.exception() != None:
+            self.errors.append(future.exception())
+
+    def close(self):
+        """ waits for the queued snapshots, raising the first error from writing them """
+
+        with timed("snapshots"):
+            self.executor.shutdown(wait=True)
+        if len(self.errors) > 0:
+            raise self.errors[0]
+
+def get_snapshot_options(output_json_file, snapshot_dir=None, snapshot_format="csv", snapshot_max_bytes=None, value_max_bytes=None, value_dir=None):
+    """ arguments for SnapshotWriter. by default snapshots go in the data directory
+    next to the directory of the Prov-JSON file, ie results/../data
+    when writing to stdout ('-') they are only written to snapshot_dir, otherwise dataframes stay data nodes """
+
+    if output_json_file == "-":
+        relative_to = os.getcwd()
+    else:
+        relative_to = os.path.dirname(os.path.abspath(output_json_file))
+        if snapshot_dir == None:
+            snapshot_dir = os.path.join(relative_to, "..", "data")
+    if snapshot_dir != None:
+        snapshot_dir = os.path.abspath(snapshot_dir)
+    if value_dir != None:
+        value_dir = os.path.abspath(value_dir)
+
+    return {"root": snapshot_dir, "relative_to": relative_to, "fmt": snapshot_format, "max_bytes": snapshot_max_bytes,
+            "value_max_bytes": value_max_bytes, "value_dir": value_dir}
+
+@profiled
+def add_data_edge(result, s, d_count, e_count, current_p, script_name, snapshots=None):
     """ makes intermediate data node if process had return value
-    if dataframe, make a snapshot csv
+    if a printed dataframe, queue a snapshot file on the SnapshotWriter
     else, make a normal data node as a string """
 
     # make data node
@@ -274,68 +1089,21 @@ def add_data_edge(result, s, d_count, e_count, current_p, script_name):
     for i in range (0, len(keys)):
         current_data_node[keys[i]] = values[i]
 
-    # -------STRING FORMATTING FOR PRINTING---------
-    # Cases to test:
-    # full df
-    # full labeled df
-    # labelled subset
-    # unlabelled subset
-    # labelled subset len >1
-    # unlabelled subset len >1
-    # Check all if statements with more script examples
+    table = parse_return_value(s[3])
 
-    df = None
-
-    if s[3]!=None:
-        y = s[3].split("\n")
-
-        # use first line and last line to figure out formatting
-        first_line = y[0].strip()
-        last_line = y[-1].strip()
-
-        # convert to df if full or subsetted df
-
-        if "Unnamed:" in first_line: # entire dataframe
-            col_names = first_line.split()[1:]
-            data = []
-            for l in y[1:]:
-                line = l.split()[1:]
-                data.append(line)
-            df = pandas.DataFrame(data, columns = col_names)
-
-        elif "Name:" in last_line: # subset of dataframe
-            col_names = []
-            temp = last_line.split()
-            for i in range (1, int(len(temp)/2), 2):
-                col_names.append(temp[i].strip(","))
-            data = []
-            for l in y[:-1]:
-                line = l.split()[1:]
-                data.append(line)
-            df = pandas.DataFrame(data, columns = col_names)
-
-        else: # integer value or different type of return statement
-            # debug or return as string
-            print("something else, need to debug or just return as a string")
-
-    if isinstance(df, pandas.core.frame.DataFrame):
-        current_data_node['rdt:type'] = "Snapshot"
-        # make dir if it doesn't exist
-        filename = "line" + str(s[4]) + "data.csv"
-        script = script_name.split("/")[-1].strip(".py")
-        # TO DO: relative path
-        directory = "/Users/jen/Desktop/newNow/data/intermediate_values_of_" + script + "_data/"
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        path = directory + filename
-        #write to csv
-        df.to_csv(path)
-        # TO DO: relative path
-        # current_data_node['rdt:value'] = path
-        current_data_node['rdt:value'] = "../data/intermediate_values_of_testJ_data/" + filename
+    if table != None and snapshots != None and snapshots.root != None:
+        path = snapshots.add(table, s[3], script_name)
+        if path != None:
+            current_data_node['rdt:type'] = "Snapshot"
+            current_data_node['rdt:value'] = path
+        else: # over the size cap
+            current_data_node['rdt:type'] = "Data"
+            current_data_node['rdt:value'] = "snapshot of " + str(len(s[3].encode())) + " bytes not saved"
     else:
         current_data_node['rdt:type'] = "Data"
-        if s[3]!=None:
+        if s[3]!=None and snapshots != None:
+            current_data_node['rdt:value'] = snapshots.add_value(s[3])
+        elif s[3]!=None:
             current_data_node['rdt:value'] = s[3]
         else:
             current_data_node['rdt:value'] = "None"
@@ -357,24 +1125,27 @@ def add_data_edge(result, s, d_count, e_count, current_p, script_name):
 
     return d_count, e_count, dkey_string
 
-def get_arguments_from_sql(input_db_file, return_value, run_num, activation_id_to_p_string):
-    """ queries sql database to find functions dependent on intermediate return value
-    returns the process_string of these processes """
+@profiled
+def get_arguments_from_sql(db, run_num):
+    """ queries sql database once for the arguments that match a return value in the trial
+    returns a dict of value_key(value) -> function_activation_ids of the processes that used it """
 
-    target_processes = []
-    db = sqlite3.connect(input_db_file, uri=True)
+    dependent_processes = {}
     c = db.cursor()
 
-    c.execute('SELECT trial_id, value, function_activation_id from object_value where trial_id = ? and value = ?', (run_num, return_value, ))
-    all_dep_processes = c.fetchall()
+    # join against the trial's return values so only possible matches come back
+    c.execute(QUERIES["arguments"], (run_num, run_num, ))
 
-    # get all dependent processes and convert to p_string
-    for p in all_dep_processes:
-        process = p[2]
-        p_string = activation_id_to_p_string[process]
-        target_processes.append(p_string)
+    # group by value, keeping the order the database returned them in
+    rows = 0
+    for value, process in c:
+        dependent_processes.setdefault(value_key(value), []).append(process)
+        rows += 1
+    count("object_value rows", rows)
 
-    return target_processes
+    c.close()
+
+    return dependent_processes
 
 def int_data_to_process(dkey_string, process_string, e_count, result):
     """ adds edge from intermediate data node to dependent process node """
@@ -391,9 +1162,288 @@ def int_data_to_process(dkey_string, process_string, e_count, result):
 
     return e_count
 
-def make_dict(script_steps, files, input_db_file, run_num, func_ends, end_funcs, p_count, d_count, e_count, outfiles, result, data_dict, finish_node, script_name, loop_dict):
+def get_summary_options(first=None, last=None, every=None, max_depth=None):
+    """ options for summarised DDGs, or None to keep every step
+    loops are sampled if any of first, last or every is given: only their first and last iterations,
+    and every Kth, get nodes. the other iterations are counted in a summary node at the end of the loop
+    functions called deeper than max_depth are collapsed into one node, 0 collapses every function """
+
+    if first == None and last == None and every == None and max_depth == None:
+        return None
+
+    sample = first != None or last != None or every != None
+    return {"sample": sample, "first": first or 0, "last": last or 0, "every": every or 0, "max_depth": max_depth}
+
+def new_loop(number, scope):
+    """ what make_dict and count_loop_iterations know about one run of a loop
+    number: runs of loops are numbered in the order they start
+    scope: the loop in the scope index """
+
+    return {"kind": "loop", "name": scope["name"], "scope": scope, "number": number, "entered": False,
+            "header step": None, "first step": None, "iterations": 0, "total": None, "start": None, "visible": False,
+            "collapsed": None, "hidden": False, "skipped": 0, "hidden steps": 0,
+            "values": 0, "min": None, "max": None, "sum": 0.0, "numeric": True}
+
+def new_function(s, scope_index, func_ends):
+    """ what make_dict and count_loop_iterations know about one call of a function
+    its scope is the definition of the function in the script, or None if it was not found,
+    in which case it ends on its last line from the database, as before the scope index """
+
+    scope = None
+    scopes = scope_index["functions"].get(s[2], [])
+    if len(scopes) == 1:
+        scope = scopes[0]
+    else:
+        # redefined functions: the definition the database's last line falls in
+        for candidate in scopes:
+            if candidate["first"] <= func_ends[s[2]] <= candidate["last"]:
+                scope = candidate
+
+    return {"kind": "function", "name": s[2], "scope": scope, "end": func_ends[s[2]],
+            "visible": False, "collapsed": None}
+
+def new_iteration(loop, s):
+    """ whether step s, in the body of the loop, starts an iteration:
+    it is the first step of the body, or the body has come back to it """
+
+    if loop["first step"] == None:
+        loop["first step"] = (s[4], s[2])
+        return True
+    return (s[4], s[2]) == loop["first step"]
+
+def close_scopes(scope_stack, s):
+    """ pops the loops and functions step s is outside of, innermost first, and returns them
+    a for loop whose header runs again after its body is closed too, so the step opens it again.
+    the step that first ran the header runs it again, other steps on the header are lazy iterators """
+
+    closed = []
+    line = s[4]
+    while len(scope_stack) > 1:
+        entry = scope_stack[-1]
+        scope = entry["scope"]
+
+        # a function without a definition ends on its last line, after its step
+        if scope == None:
+            break
+        if line < scope["first"] or line > scope["last"]:
+            closed.append(scope_stack.pop())
+            continue
+        if entry["kind"] == "loop" and scope["rerun"] and entry["entered"] and line <= scope["header end"]:
+            if entry["header step"] == None or entry["header step"] == (line, s[2]):
+                closed.append(scope_stack.pop())
+        break
+
+    return closed
+
+def open_loops(scope_stack, s, scope_index, func_ends):
+    """ pushes the loops step s is in that are not open yet, outermost first, and returns them
+    with the loop whose Start node the step is, if it is on the header of the innermost one
+    and not a function call. loops are only looked for up to the innermost open scope
+    or the definition of the function the step is in """
+
+    opened = []
+    line = s[4]
+    top = scope_stack[-1]
+
+    # steps of functions defined elsewhere have lines of another file
+    if top["kind"] == "function" and top["scope"] == None:
+        return opened, None
+
+    scope = scope_of(scope_index, line)
+    if scope is not top["scope"]:
+        while scope != None and scope is not top["scope"] and scope["kind"] != "function":
+            if scope["kind"] == "loop":
+                opened.append(scope)
+            scope = scope["parent"]
+        opened.reverse()
+
+        for i in range (0, len(opened)):
+            opened[i] = new_loop(scope_stack[0]["loops started"], opened[i])
+            scope_stack[0]["loops started"] += 1
+            scope_stack.append(opened[i])
+
+    # the step is in the body of the innermost loop unless it is on its header
+    consumed = None
+    top = scope_stack[-1]
+    if top["kind"] == "loop":
+        on_header = line <= top["scope"]["header end"]
+        if not on_header:
+            top["entered"] = True
+        elif len(opened) > 0:
+            top["header step"] = (line, s[2])
+            if s[2] not in func_ends:
+                consumed = top
+
+    return opened, consumed
+
+def close_function(scope_stack, s):
+    """ pops the innermost function if it has no definition and step s is on its last line,
+    with the loops still open in it, innermost first, and returns them """
+
+    closed = []
+    for i in range (len(scope_stack)-1, 0, -1):
+        entry = scope_stack[i]
+        if entry["kind"] == "function":
+            if entry["scope"] == None and s[4] == entry["end"]:
+                while len(scope_stack) > i:
+                    closed.append(scope_stack.pop())
+            break
+
+    return closed
+
+def new_scope_stack():
+    """ the stack of open loops and functions, starting with the script """
+
+    return [{"kind": "script", "name": None, "scope": None, "visible": False, "collapsed": None, "loops started": 0}]
+
+def keep_iteration(summary, i, total=None):
+    """ whether iteration i (from 0) of a loop with total iterations gets nodes """
+
+    if i < summary["first"]:
+        return True
+    if summary["every"] > 0 and i % summary["every"] == 0:
+        return True
+    return total != None and i >= total - summary["last"]
+
+def count_loop_iterations(db, run_num, func_ends, scope_index):
+    """ first pass for summaries that keep the last iterations of loops:
+    the number of iterations of each run of a loop, in the order they start
+    follows the scope stack the same way make_dict does, without making nodes """
+
+    totals = []
+    script_steps = get_script_steps(db, run_num)
+    next(script_steps)
+    scope_stack = new_scope_stack()
+
+    for s, file_access in script_steps:
+        close_scopes(scope_stack, s)
+
+        if scope_stack[-1]["kind"] == "loop" and new_iteration(scope_stack[-1], s):
+            totals[scope_stack[-1]["number"]] += 1
+
+        opened, consumed = open_loops(scope_stack, s, scope_index, func_ends)
+        for loop in opened:
+            totals.append(0)
+        if len(opened) > 0 and consumed == None and new_iteration(opened[-1], s):
+            totals[opened[-1]["number"]] += 1
+
+        if s[2] in func_ends:
+            scope_stack.append(new_function(s, scope_index, func_ends))
+
+        close_function(scope_stack, s)
+
+    return totals
+
+def add_to_loop_summary(loop, value):
+    """ aggregates the return value of a step in a hidden iteration of the loop """
+
+    loop["values"] += 1
+    if loop["numeric"]:
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            loop["numeric"] = False
+            return
+        loop["sum"] += number
+        if loop["min"] == None or number < loop["min"]:
+            loop["min"] = number
+        if loop["max"] == None or number > loop["max"]:
+            loop["max"] = number
+
+def add_loop_summary(result, loop, d_count, e_count, current_p):
+    """ adds a data node generated by the Finish node of a sampled loop,
+    with its iterations and the steps and return values of the ones without nodes """
+
+    value = str(loop["iterations"]) + " iterations, " + str(loop["skipped"]) + " not shown (" + str(loop["hidden steps"]) + " steps)"
+    value += ", " + str(loop["values"]) + " return values not shown"
+    if loop["values"] > 0 and loop["numeric"]:
+        value += ": min " + repr(loop["min"]) + ", max " + repr(loop["max"]) + ", mean " + repr(loop["sum"] / loop["values"])
+
+    # make data node
+    summary_node = {}
+    summary_node['rdt:name'] = "loop summary"
+    summary_node['rdt:type'] = "Data"
+    summary_node['rdt:scope'] = "R_GlobalEnv"
+    summary_node["rdt:fromEnv"] = "FALSE"
+    summary_node["rdt:timestamp"] = ""
+    summary_node["rdt:location"] = ""
+    summary_node['rdt:value'] = value
+
+    dkey_string = "d" + str(d_count)
+    d_count+=1
+    result["entity"][dkey_string] = summary_node
+
+    # make edge
+    current_edge_node = {}
+    current_edge_node['prov:activity'] = current_p
+    current_edge_node['prov:entity'] = dkey_string
+
+    e_string = "e" + str(e_count)
+    e_count+=1
+    result['wasGeneratedBy'][e_string] = current_edge_node
+
+    return d_count, e_count
+
+def hide(hide_stack, owner, representative):
+    """ starts hiding steps, ie a skipped iteration or a collapsed function
+    hidden steps are attached to the node of the outermost owner """
+
+    hide_stack.append((owner, representative))
+
+def unhide(hide_stack, owner):
+    """ stops hiding the steps of owner """
+
+    for i in range (len(hide_stack)-1, -1, -1):
+        if hide_stack[i][0] is owner:
+            del hide_stack[i]
+            return
+
+def sample_iteration(summary, hide_stack, loop, s):
+    """ if step s starts an iteration of a sampled loop with a Start node,
+    decides whether the iteration gets nodes, hiding its steps if not """
+
+    if loop["start"] == None or not new_iteration(loop, s):
+        return
+
+    loop["iterations"] += 1
+    shown = keep_iteration(summary, loop["iterations"]-1, loop["total"])
+    if loop["hidden"] and shown:
+        unhide(hide_stack, loop)
+        loop["hidden"] = False
+    elif not shown:
+        if not loop["hidden"]:
+            hide(hide_stack, loop, loop["start"])
+            loop["hidden"] = True
+        loop["skipped"] += 1
+
+def add_finish(result, entry, hide_stack, p_count, d_count, e_count, prev_p):
+    """ ends a loop or function popped from the scope stack: its steps are no longer hidden,
+    and if it has a Start node, a Finish node is added after prev_p,
+    with the summary of a sampled loop. returns the counts and the new prev_p """
+
+    if entry["kind"] == "loop" and entry["hidden"]:
+        unhide(hide_stack, entry)
+    if entry["collapsed"] != None:
+        unhide(hide_stack, entry["collapsed"])
+
+    # add the finish node and the informs edge from the last process node in it
+    if entry["visible"]:
+        current_p, p_count = add_end_node(result, p_count, entry["name"])
+        e_count = add_informs_edge(result, prev_p, current_p, e_count)
+        prev_p = "p" + str(p_count-1)
+        if entry["kind"] == "loop" and entry["skipped"] > 0:
+            d_count, e_count = add_loop_summary(result, entry, d_count, e_count, current_p)
+
+    return p_count, d_count, e_count, prev_p
+
+@profiled
+def make_dict(script_steps, db, run_num, func_ends, end_funcs, p_count, d_count, e_count, outfiles, result, data_dict, finish_node, script_name, scope_index, snapshots=None, summary=None):
     """ uses the information from the database
     to make a dictionary compatible with Prov-JSON format
+    script_steps is an iterator of (step, file access), so steps are read once, in order,
+    and only what the stacks and the used edges need is kept
+    summary: from get_summary_options, to sample loops and collapse deep functions.
+    steps without nodes are attached to the Start node of their loop or the node of their function
 
     1. Get Defaults and start node
     2. Loop through script_steps
@@ -405,8 +1455,8 @@ def make_dict(script_steps, files, input_db_file, run_num, func_ends, end_funcs,
     """
 
     # if first script in list, set up the default formats
-    if len(result.keys()) == 0:
-        result = get_defaults(script_name)
+    if len(result.get('activity', {})) == 0:
+        result = get_defaults(script_name, result)
 
     # if not first script, add informs edge between
     # the Finish of the previous script and the Start of the current script
@@ -415,179 +1465,1244 @@ def make_dict(script_steps, files, input_db_file, run_num, func_ends, end_funcs,
         e_count = add_informs_edge(result, finish_node, current_p, e_count)
 
     # initialize per-script variables
-    process_stack, loop_name_stack, loop_stack, function_stack = [], [], [], []
     int_values, int_dkey_strings = [], []
     dkey_string = -1
     activation_id_to_p_string = {}
 
-    prev_p, p_count = add_start_node(result, script_steps[0], p_count)
-    process_stack.append(script_steps[0][4])
-    function_stack.append(script_steps[0][4])
-    current_line = ""
+    # for summaries: what is hiding steps, and the files hidden steps already added
+    hide_stack = []
+    hidden_files = set()
+    sample_loops = summary != None and summary["sample"]
+    max_depth = summary["max_depth"] if summary != None else None
+    totals = None
+    if sample_loops and summary["last"] > 0:
+        with timed("SQL fetch"):
+            totals = count_loop_iterations(db, run_num, func_ends, scope_index)
+
+    script_info = get_script_info(script_name)
+
+    # the processes that use a return value, so only their p_strings and the matching values are kept
+    with timed("dependency edges"):
+        dependent_processes = get_arguments_from_sql(db, run_num)
+    used_ids = set()
+    for processes in dependent_processes.values():
+        used_ids.update(processes)
+
+    script_steps = iter(script_steps)
+    first_step = next(script_steps)[0]
+    prev_p, p_count = add_start_node(result, first_step, p_count)
+
+    # the open loops and functions, each with whether it has a Start node
+    scope_stack = new_scope_stack()
+    steps, file_accesses, data_nodes, hidden_steps = 1, 0, 0, 0
 
     # iterate through each line in the script
-    for i in range (1, len(script_steps)):
-        s = script_steps[i]
+    for s, file_access in script_steps:
+        steps += 1
 
         # get the line of the script
-        next_line=""
-        with open(script_name) as f:
-            # subtract 1 from s[4] because script_steps starts at [1] to avoid redundant start node
-            for i, line in enumerate(f):
-                if i == s[4]-1:
-                    next_line = line
-                elif i > s[4]-1:
-                    break
-
-        # if loop has ended on current step, add finish node
-        if len(loop_stack)>0 and s[4] >= loop_stack[-1]:
-            # get the function name
-            func_name = loop_name_stack.pop()
-
-            # add the finish node and pop from the stacks
-            current_p, p_count = add_end_node(result, p_count, func_name)
-            process_stack.pop()
-            loop_stack.pop()
-
-            # add informs edge between last process node in loop and the finish node of the loop
-            e_count = add_informs_edge(result, prev_p, current_p, e_count)
-            prev_p = "p" + str(p_count-1)
+        next_line = get_line(script_info, s[4])
+
+        # if loops or functions have ended before the current step, add their finish nodes
+        for entry in close_scopes(scope_stack, s):
+            p_count, d_count, e_count, prev_p = add_finish(result, entry, hide_stack, p_count, d_count, e_count, prev_p)
+
+        # if a sampled loop starts an iteration, decide whether it gets nodes
+        if sample_loops and scope_stack[-1]["kind"] == "loop":
+            sample_iteration(summary, hide_stack, scope_stack[-1], s)
+
+        # if current step is in loops that have not started, add their start nodes
+        # a step on the header of the loop is its start node, like the range of a for loop
+        opened, consumed = open_loops(scope_stack, s, scope_index, func_ends)
+        for loop in opened:
+            if totals != None:
+                loop["total"] = totals[loop["number"]]
+            if len(hide_stack) == 0:
+                current_p, p_count = add_start_node(result, s, p_count, loop["name"])
+                loop["start"] = current_p
+                loop["visible"] = True
+                if loop is not consumed:
+                    e_count = add_informs_edge(result, prev_p, current_p, e_count)
+                    prev_p = current_p
+        if sample_loops and len(opened) > 0 and consumed == None:
+            sample_iteration(summary, hide_stack, opened[-1], s)
+
+        # a hidden step gets no nodes, it is attached to the node hiding it
+        hidden = len(hide_stack) > 0
+        if hidden:
+            current_p = hide_stack[0][1]
+            hidden_steps += 1
+            if isinstance(hide_stack[0][0], dict):
+                hide_stack[0][0]["hidden steps"] += 1
 
         # if current step is a function, add start node
-        # store the function_activation_id in stack to be able to make Finish node
+        # and push it on the stack to be able to make Finish node
         if s[2] in func_ends:
-            current_p, p_count = add_start_node(result, s, p_count)
-            process_stack.append(func_ends[s[2]])
-            function_stack.append(func_ends[s[2]])
-
-        # if current_step is the start of a loop, add start node
-        # store the last line in loop in stack to be able to make Finish node
-        elif s[4] in loop_dict.keys():
-            current_p, p_count = add_start_node(result, s, p_count, next_line.strip())
-            process_stack.append(loop_dict[s[4]])
-            loop_name_stack.append(next_line.strip())
-            loop_stack.append(loop_dict[s[4]])
+            function = new_function(s, scope_index, func_ends)
+            if hidden:
+                pass
+            elif max_depth != None and len([entry for entry in scope_stack if entry["kind"] != "loop"]) > max_depth:
+                # collapsed: one node for the call, its steps are hidden
+                p_count, current_p = add_process(result, s[2], p_count, s, script_name, next_line)
+                function["collapsed"] = [current_p]
+                hide(hide_stack, function["collapsed"], current_p)
+            else:
+                current_p, p_count = add_start_node(result, s, p_count)
+                function["visible"] = True
+            scope_stack.append(function)
 
         # if no special cases, add normal process node
-        else:
+        elif consumed == None and not hidden:
             p_count, current_p = add_process(result, s[2], p_count, s, script_name, next_line)
 
-        # dict for use in get_arguments_from_sql
-        activation_id_to_p_string[s[1]] = current_p
+        # dict for use in get_arguments_from_sql and add_file
+        if s[1] in used_ids or file_access != None:
+            activation_id_to_p_string[s[1]] = current_p
 
         # if process node reads or writes to file, add file nodes and edges
         # TO DO: read file not detected unless with open() as f format.
-        if s[1] in files.keys():
-            d_count, e_count = add_file(result, files, d_count, e_count, current_p, s, outfiles, script_steps[0], activation_id_to_p_string, data_dict)
+        if file_access != None:
+            file_accesses += 1
+            # hidden steps add each file once to the node they are attached to
+            file_key = (current_p, file_access["name"], file_access["mode"], file_access["hash"])
+            if hidden and file_key in hidden_files:
+                pass
+            elif isinstance(result['activity'], RecordingSection):
+                # parallel mode: whether the file already has a node depends on the
+                # earlier trials, so the file is added when the trial is merged
+                result['activity'].events.append(("file", current_p, s, file_access))
+            else:
+                d_count, e_count = add_file(result, file_access, d_count, e_count, current_p, s, outfiles, first_step, activation_id_to_p_string, data_dict)
+            if hidden:
+                hidden_files.add(file_key)
 
         # if process node has return statement, make intermediate data node and edges
         if s[3] != "None":
-            d_count, e_count, dkey_string = add_data_edge(result, s, d_count, e_count, current_p, script_name)
-            int_values.append(s[3])
-            int_dkey_strings.append(dkey_string)
+            if hidden:
+                if isinstance(hide_stack[0][0], dict):
+                    add_to_loop_summary(hide_stack[0][0], s[3])
+            else:
+                d_count, e_count, dkey_string = add_data_edge(result, s, d_count, e_count, current_p, script_name, snapshots)
+                data_nodes += 1
+                # matched by key, so long values are not kept for the dependency edges
+                key = value_key(s[3]) if s[3] != None else None
+                if key in dependent_processes:
+                    int_values.append(key)
+                    int_dkey_strings.append(dkey_string)
 
         # add_informs_edge between all process nodes
-        e_count = add_informs_edge(result, prev_p, current_p, e_count)
-        prev_p = "p" + str(p_count-1)
-
-        # if function, NOT LOOP, has ended on current step, add finish node
-        if s[4] == function_stack[-1]:
-            # get the function name
-            func_name = end_funcs[s[4]]
-
-            # add the finish node and pop from the stack
-            current_p, p_count = add_end_node(result, p_count, func_name)
-            process_stack.pop()
-            function_stack.pop()
-
-            # add informs edge between last process node in loop and the finish node of the loop
+        if not hidden:
             e_count = add_informs_edge(result, prev_p, current_p, e_count)
             prev_p = "p" + str(p_count-1)
 
+        # if a function defined outside the script has ended on current step, add finish node
+        for entry in close_function(scope_stack, s):
+            if entry["kind"] == "function":
+                entry["name"] = end_funcs.get(s[4], entry["name"])
+            p_count, d_count, e_count, prev_p = add_finish(result, entry, hide_stack, p_count, d_count, e_count, prev_p)
+
     # after all steps in script done
     # add finish nodes (both loops and functions)
-    #and informs edges for the rest of the process_stack
-    while len(process_stack)>1:
-        func_line = process_stack.pop()
-        try: # get the func name
-            func_name = end_funcs[func_line]
-        except: # get the loop name
-            func_name = loop_name_stack.pop()
-
-        # add the finish node and edge
-        current_p, p_count = add_end_node(result, p_count, func_name)
-        e_count = add_informs_edge(result, prev_p, current_p, e_count)
-        prev_p = "p" + str(p_count-1)
+    # and informs edges for the rest of the scope stack
+    while len(scope_stack)>1:
+        p_count, d_count, e_count, prev_p = add_finish(result, scope_stack.pop(), hide_stack, p_count, d_count, e_count, prev_p)
 
     # add finish node and final informs edge for the script
-    current_p, p_count = add_end_node(result, p_count, script_steps[0][2])
+    current_p, p_count = add_end_node(result, p_count, first_step[2])
     e_count = add_informs_edge(result, prev_p, current_p, e_count)
 
     # adds used edges using dependencies from database table: object_value
     # TO DO: prevent edges that go up?
-    for i in range (0, len(int_values)):
-        # print(i) #52309
-        return_value = int_values[i]
-        target_processes = get_arguments_from_sql(input_db_file, return_value, run_num, activation_id_to_p_string)
-        for process in target_processes:
-            e_count = int_data_to_process(int_dkey_strings[i], process, e_count, result)
+    with timed("dependency edges"):
+        first_edge = e_count
+        # hidden steps share a node, so the same edge is only added once
+        used_edges = set()
+        for i in range (0, len(int_values)):
+            # get all dependent processes and convert to p_string
+            for process in dependent_processes.get(int_values[i], []):
+                process_string = activation_id_to_p_string[process]
+                if summary != None:
+                    if (int_dkey_strings[i], process_string) in used_edges:
+                        continue
+                    used_edges.add((int_dkey_strings[i], process_string))
+                e_count = int_data_to_process(int_dkey_strings[i], process_string, e_count, result)
+        count("value used edges", e_count - first_edge)
+
+    count("activations", steps)
+    count("file accesses", file_accesses)
+    count("data nodes", data_nodes)
+    if summary != None:
+        count("steps hidden", hidden_steps)
+
+    return result, p_count, d_count, e_count, outfiles, current_p, first_step
+
+# AST nodes in the scope index, and the kind of scope each is
+SCOPE_KINDS = [((ast.For, ast.AsyncFor, ast.While), "loop"),
+               ((ast.FunctionDef, ast.AsyncFunctionDef), "function"),
+               ((ast.With, ast.AsyncWith), "with")]
+
+def get_scope_index(script_name):
+    """ uses ast module to find the first and last lines of every loop, function definition and with block
+    to allow for collapsible nodes for loops (as well as functions)
+    scopes nest, so each line keeps its innermost scope and each scope its parent:
+    the scope of a line is looked up in O(1), and the scopes a step enters in O(number of scopes)
+    shares the parsed tree with make_dict's line lookups, and is built once per script """
+
+    script_info = get_script_info(script_name)
+    with script_lock:
+        if "scopes" in script_info:
+            return script_info["scopes"]
+
+    lines = script_info["lines"]
+    innermost = [None] * (len(lines) + 1)
+    functions = {}
+
+    # parents are visited before their children, so each line ends with its innermost scope
+    nodes = [(script_info["tree"], None)]
+    while len(nodes) > 0:
+        node, parent = nodes.pop()
+        for child in ast.iter_child_nodes(node):
+            kind = None
+            for types, name in SCOPE_KINDS:
+                if isinstance(child, types):
+                    kind = name
+            if kind == None:
+                nodes.append((child, parent))
+                continue
+
+            # the header ends before the body, ie the lines of a for split over several lines
+            first, last = child.lineno, min(child.end_lineno, len(lines))
+            scope = {"kind": kind, "first": first, "last": last, "parent": parent,
+                     "header end": max(child.body[0].lineno - 1, first),
+                     "rerun": isinstance(child, (ast.For, ast.AsyncFor)),
+                     "name": get_line(script_info, first).strip()}
+            if kind == "function":
+                scope["name"] = child.name
+                functions.setdefault(child.name, []).append(scope)
+            for line in range (first, last+1):
+                innermost[line] = scope
+            nodes.append((child, scope))
+
+    # the first index built is kept if several threads built one
+    with script_lock:
+        return script_info.setdefault("scopes", {"innermost": innermost, "functions": functions})
+
+def scope_of(scope_index, line):
+    """ the innermost loop, function definition or with block line is in, or None """
+
+    if line == None or line < 1 or line >= len(scope_index["innermost"]):
+        return None
+    return scope_index["innermost"][line]
+
+def open_json_file(json_file, mode):
+    """ opens a Prov-JSON file as text, or stdout for '-' when writing
+    .gz files are gzip compressed, .zst files zstd compressed (needs python 3.14 or zstandard) """
+
+    if json_file == "-":
+        return contextlib.nullcontext(sys.stdout if mode == 'w' else sys.stdin)
+
+    compression = OUTPUT_COMPRESSIONS.get(os.path.splitext(json_file)[1])
+    if compression == "gzip":
+        return gzip.open(json_file, mode + 't', encoding="utf-8")
+    elif compression == "zstd":
+        try:
+            from compression import zstd
+        except ImportError:
+            import zstandard as zstd
+        return zstd.open(json_file, mode + 't', encoding="utf-8")
+
+    return open(json_file, mode, encoding="utf-8")
+
+def open_output(output_json_file):
+    """ opens the file to write the Prov-JSON to, or stdout for '-' """
+
+    return open_json_file(output_json_file, 'w')
 
-    return result, p_count, d_count, e_count, outfiles, current_p
+def write_json(dictionary, output_json_file):
+    with open_output(output_json_file) as outfile:
+        json.dump(dictionary, outfile, default=to_json_default)
+
+def write_sections(result, output_json_file, dumps=None):
+    """ writes a result made of SpillSections or CompactSections as one Prov-JSON file
+    CompactSections are serialised with dumps, see get_json_dumps. SpillSections already are """
+
+    with open_output(output_json_file) as outfile:
+        outfile.write("{")
+        for i in range (0, len(SECTIONS)):
+            if i > 0:
+                outfile.write(", ")
+            outfile.write(json.dumps(SECTIONS[i]) + ": {")
+            if isinstance(result[SECTIONS[i]], CompactSection):
+                result[SECTIONS[i]].write(outfile, dumps)
+            else:
+                result[SECTIONS[i]].write(outfile)
+            outfile.write("}")
+        outfile.write("}")
+
+def get_output_format(output_file, output_format=None):
+    """ json, sqlite or parquet, from output_format or else from the extension of output_file """
+
+    if output_format == None:
+        output_format = OUTPUT_FORMATS.get(os.path.splitext(output_file)[1], "json")
+    if output_format not in ("json", "sqlite", "parquet"):
+        raise ValueError("unknown output format: " + output_format)
+    if output_format != "json" and output_file == "-":
+        raise ValueError(output_format + " output needs a file name")
+
+    return output_format
+
+def get_table_columns(section):
+    """ attribute names used by the nodes or edges of a section, in the order first seen """
+
+    columns = OrderedDict()
+    for key, value in section.items():
+        for name in value:
+            columns[name] = None
+
+    return list(columns)
+
+def write_sqlite_tables(result, output_file):
+    """ writes the DDG as a sqlite database with one table per section
+    each row is a node or edge: its id, then one column per attribute, NULL where it has none
+    edge endpoints are indexed, so lineage can be queried without loading the graph """
+
+    db = sqlite3.connect(output_file)
+
+    for key in SECTIONS:
+        columns = get_table_columns(result[key])
+        names = ['"id" TEXT PRIMARY KEY'] + ['"' + name + '" TEXT' for name in columns]
+        db.execute('CREATE TABLE "' + key + '" (' + ", ".join(names) + ')')
+        insert = 'INSERT INTO "' + key + '" VALUES (' + ", ".join(["?"] * (len(columns)+1)) + ')'
+
+        rows = []
+        for node_id, value in result[key].items():
+            rows.append([node_id] + [value.get(name) for name in columns])
+            if len(rows) == TABLE_BATCH:
+                db.executemany(insert, rows)
+                rows = []
+        db.executemany(insert, rows)
+
+        for name in TABLE_INDEXES.get(key, []):
+            if name in columns:
+                db.execute('CREATE INDEX "' + key + "_" + name + '" on "' + key + '" ("' + name + '")')
+
+    db.commit()
+    db.close()
+
+def write_parquet_tables(result, output_dir):
+    """ writes the DDG as a directory of parquet files, one per section, with the same columns
+    as write_sqlite_tables. pyarrow is only imported here """
+
+    import pyarrow
+    import pyarrow.parquet
+
+    os.makedirs(output_dir, exist_ok=True)
+    for key in SECTIONS:
+        columns = get_table_columns(result[key])
+        schema = pyarrow.schema([(name, pyarrow.string()) for name in ["id"] + columns])
+
+        with pyarrow.parquet.ParquetWriter(os.path.join(output_dir, key + ".parquet"), schema) as writer:
+            rows = []
+            for node_id, value in result[key].items():
+                row = {"id": node_id}
+                row.update(value)
+                rows.append(row)
+                if len(rows) == TABLE_BATCH:
+                    writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+                    rows = []
+            writer.write_table(pyarrow.Table.from_pylist(rows, schema=schema))
+
+def get_temp_path(output_file):
+    """ path next to output_file, with the same extension, to write to before replacing it
+    named by process and thread, so writers of the same file do not share it """
+
+    directory, name = os.path.split(output_file)
+    return os.path.join(directory, ".tmp" + str(os.getpid()) + "-" + str(threading.get_ident()) + "-" + name)
+
+def remove_path(path):
+    """ removes a file or directory if it exists """
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """ yields a temporary path next to path to write a file or directory to,
+    which replaces path at the end of the with block, so a reader never sees one half written
+    if the block fails, the temporary path is removed and path is left as it was """
+
+    temp_path = get_temp_path(path)
+    remove_path(temp_path)
+    try:
+        yield temp_path
+        # a directory, ie parquet tables, cannot be replaced while it has files
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(temp_path, path)
+    finally:
+        remove_path(temp_path)
+
+def write_output(result, output_file, output_format=None, json_backend="auto"):
+    """ writes the result in the format from get_output_format
+    json_backend picks the json module for Prov-JSON, see get_json_dumps
+    files are written through atomic_path, so a reader never sees one half written """
+
+    output_format = get_output_format(output_file, output_format)
+    if output_file == "-":
+        with timed("JSON write"):
+            write_sections(result, output_file, get_json_dumps(json_backend))
+        return
+
+    with atomic_path(output_file) as temp_path:
+        if output_format == "sqlite":
+            with timed("table write"):
+                write_sqlite_tables(result, temp_path)
+        elif output_format == "parquet":
+            with timed("table write"):
+                write_parquet_tables(result, temp_path)
+        else:
+            with timed("JSON write"):
+                write_sections(result, temp_path, get_json_dumps(json_backend))
+
+def read_ddg(ddg_file, output_format=None):
+    """ reads a DDG written in any of the output formats back into a dict of sections
+    attributes that are NULL in the sqlite or parquet tables are left out """
+
+    output_format = get_output_format(ddg_file, output_format)
+
+    if output_format == "json":
+        with open_json_file(ddg_file, 'r') as infile:
+            return json.load(infile)
+
+    result = OrderedDict()
+    for key in SECTIONS:
+        result[key] = OrderedDict()
+        if output_format == "sqlite":
+            db = sqlite3.connect(db_uri(ddg_file), uri=True)
+            c = db.execute('SELECT * from "' + key + '"')
+            names = [column[0] for column in c.description]
+            rows = (dict(zip(names, row)) for row in c)
+        else:
+            import pyarrow.parquet
+            rows = pyarrow.parquet.read_table(os.path.join(ddg_file, key + ".parquet")).to_pylist()
 
-def get_loop_locations(script_name):
-    """ uses ast module to find the start and end lines of for and while loops
-    to allow for collapsible nodes for loops (as well as functions) """
+        for row in rows:
+            node_id = row.pop("id")
+            result[key][node_id] = dict((name, value) for name, value in row.items() if value != None)
 
-    loop_dict = {}
+        if output_format == "sqlite":
+            db.close()
 
-    with open(script_name) as f:
-        tree = ast.parse(f.read())
+    return result
 
-    for node in ast.walk(tree):
-        if isinstance(node, (ast.For, ast.While)):
-            # keys = start line, values = finish line
-            # offset by 1 to match with script_steps numbering
-            loop_dict[node.lineno] = node.body[-1].lineno+1
+def get_shard_paths(output_file):
+    """ the directory the shards of a sharded DDG are written in, and the extension of the shard files,
+    ie results/ddg.json.gz has its shards in results/ddg_shards/shard-00001.json.gz """
+
+    name, compression = os.path.splitext(output_file)
+    if compression not in OUTPUT_COMPRESSIONS:
+        name, compression = output_file, ""
+    name = os.path.splitext(name)[0]
+
+    return name + "_shards", ".json" + compression
+
+class ShardSection:
+    """ stands in for one section of the result dict in sharded mode,
+    passing each node or edge to the ShardWriter that decides where it goes """
+
+    def __init__(self, name, writer):
+        self.name = name
+        self.writer = writer
+
+    def __setitem__(self, key, value):
+        self.writer.add(self.name, key, value)
+
+    def __len__(self):
+        return self.writer.counts[self.name]
+
+class ShardWriter:
+    """ splits a linked DDG into Prov-JSON shard files while it is converted, and writes an index file at the end
+    each shard holds whole trials: one trial, or with shard_nodes, trials until it has that many nodes.
+    the index holds the environment node, every file node, since files link the trials,
+    and the edges between trials of different shards, the wasInformedBy from one script's Finish to the next Start,
+    with a list of the shards, their files and trials. a shard with the index has every node its own edges need,
+    read_shards leaves out the index edges to shards it did not load
+    shards are written on background threads as soon as they are full, and are then dropped from memory """
+
+    def __init__(self, output_file, shard_nodes=None, stream=False, json_backend="auto"):
+        if get_output_format(output_file) != "json":
+            raise ValueError("sharded output is Prov-JSON, not " + get_output_format(output_file))
+        if output_file == "-":
+            raise ValueError("sharded output needs a file name")
+
+        self.output_file = output_file
+        self.directory, self.extension = get_shard_paths(output_file)
+        self.shard_nodes = shard_nodes
+        self.stream = stream
+        self.json_backend = json_backend
+
+        self.index = OrderedDict()
+        for key in SECTIONS:
+            self.index[key] = OrderedDict()
+        self.index_nodes = set()
+        self.counts = dict((key, 0) for key in SECTIONS)
+        self.shards = []
+        self.futures = []
+        self.executor = ThreadPoolExecutor(max_workers=SNAPSHOT_THREADS)
+        self.new_shard()
+
+    def get_result(self):
+        """ the result dict make_dict and merge_trial add the trials to """
+
+        result = {}
+        for key in SECTIONS:
+            result[key] = ShardSection(key, self)
+        return result
+
+    def new_shard(self):
+        if self.stream:
+            self.result = get_spill_result(get_json_dumps(self.json_backend))
+        else:
+            self.result = get_compact_result()
+        self.nodes = set()
+        self.trials = []
+        # edges added before one of their nodes, placed when the shard is written
+        self.pending = []
+
+    def add(self, section, key, value):
+        self.counts[section] += 1
+
+        if section == "activity" and key == "environment":
+            self.index[section][key] = value
+            self.index_nodes.add(key)
+        elif section == "entity" and value.get("rdt:type") == "File":
+            self.index[section][key] = value
+            self.index_nodes.add(key)
+        elif section in ("activity", "entity"):
+            self.result[section][key] = value
+            self.nodes.add(key)
+        elif self.has_nodes(value):
+            self.result[section][key] = value
+        else:
+            # ie the wasInformedBy to a trial's Start node, added just before it
+            self.pending.append((section, key, value))
+
+    def has_nodes(self, edge):
+        """ whether both nodes of an edge are in the current shard or the index """
+
+        for node in edge.values():
+            if node not in self.nodes and node not in self.index_nodes:
+                return False
+        return True
+
+    def end_trial(self, trial):
+        """ called after each trial is added, writes the shard once it is full """
+
+        self.trials.append(trial)
+        if self.shard_nodes == None or len(self.nodes) >= self.shard_nodes:
+            self.flush()
+
+    def flush(self):
+        """ queues the current shard to be written and starts the next """
+
+        if len(self.trials) == 0 and len(self.nodes) == 0:
+            return
+
+        # edges to a node of another shard go in the index
+        for section, key, value in self.pending:
+            if self.has_nodes(value):
+                self.result[section][key] = value
+            else:
+                self.index[section][key] = value
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "shard-%05d%s" % (len(self.shards)+1, self.extension))
+        self.shards.append({"file": os.path.relpath(path, os.path.dirname(os.path.abspath(self.output_file))),
+                            "trials": self.trials, "nodes": len(self.nodes),
+                            "counts": dict((key, len(self.result[key])) for key in SECTIONS)})
+        self.futures.append(self.executor.submit(write_output, self.result, path, "json", self.json_backend))
+        self.new_shard()
+
+    def close(self):
+        """ writes the last shard, waits for every shard and writes the index """
+
+        self.flush()
+        self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+
+        index = OrderedDict(self.index)
+        index["shards"] = self.shards
+        with atomic_path(self.output_file) as temp_path:
+            with timed("JSON write"):
+                write_json(index, temp_path)
+
+def read_shards(index_file, trials=None, shards=None):
+    """ reads a sharded DDG back into a dict of sections: the index and the shards needed
+    trials: only the shards holding these trials, shards: only these shards, numbered from 0.
+    by default every shard. the index edges to nodes of shards that were not read are left out """
+
+    with open_json_file(index_file, 'r') as infile:
+        index = json.load(infile)
+
+    result = OrderedDict()
+    for key in SECTIONS:
+        result[key] = index.get(key, {})
+
+    directory = os.path.dirname(os.path.abspath(index_file))
+    for i in range (0, len(index["shards"])):
+        shard = index["shards"][i]
+        if shards != None and i not in shards:
+            continue
+        if trials != None and not any(trial in trials for trial in shard["trials"]):
+            continue
+        with open_json_file(os.path.join(directory, shard["file"]), 'r') as infile:
+            part = json.load(infile)
+        for key in SECTIONS:
+            result[key].update(part.get(key, {}))
+
+    # the edges between trials, kept if both their trials were read
+    for key in SECTIONS:
+        if key in ("activity", "entity"):
+            continue
+        for edge_id in list(index.get(key, {})):
+            for node in result[key][edge_id].values():
+                if node not in result["activity"] and node not in result["entity"]:
+                    del result[key][edge_id]
+                    break
 
-    return loop_dict
+    return result
 
-def write_json(dictionary, output_json_file):
-    with open(output_json_file, 'w') as outfile:
-        json.dump(dictionary, outfile, default=lambda temp: json.loads(temp.to_json()))
+def extract_trial(input_db_file, index_db_file, snapshot_options, trial_num, live=False, summary=None):
+    """ worker for parallel mode: queries one trial and builds its subgraph with local ids
+    returns the recorded events, the number of process nodes,
+    the local finish node, the first step and the script name
+    without snapshot_options, dataframes are kept as data nodes instead of snapshot files """
+
+    db = open_db(input_db_file, index_db_file, live)
+    snapshots = SnapshotWriter(**snapshot_options) if snapshot_options != None else None
+    with timed("SQL fetch"):
+        script_steps, func_ends, end_funcs, script_name = get_info_from_sql(db, trial_num)
+    with timed("AST scope index"):
+        scope_index = get_scope_index(script_name)
+    with timed("graph build"):
+        result, p_count, d_count, e_count, outfiles, finish_node, first_step = make_dict(script_steps, db, trial_num, func_ends, end_funcs, 1, 1, 1, {}, get_recording_result(), {}, None, script_name, scope_index, snapshots, summary)
+    if snapshots != None:
+        snapshots.close()
+    db.close()
+
+    return result['activity'].events, p_count-1, finish_node, first_step, script_name
+
+def extract_trial_timed(input_db_file, index_db_file, snapshot_options, trial_num, live=False, summary=None):
+    """ runs extract_trial in a worker process, also returning the time it spent in each phase """
+
+    phase_times.clear()
+    trial = extract_trial(input_db_file, index_db_file, snapshot_options, trial_num, live, summary)
+    return trial, dict(phase_times)
+
+def renumber(key, p_offset, d_keys):
+    """ converts a local process or data key from extract_trial to its key in the linked result """
+
+    if key.startswith("p"):
+        return "p" + str(int(key[1:]) + p_offset)
+    return d_keys[key]
+
+def link_by_hash(file_access, hashes, source):
+    """ for federated mode: if a file read in database source has the contents of a file written in
+    another database, returns the access renamed to the written file so add_file reuses its node
+    hashes: content hash -> (database, name) of the files written so far """
+
+    h = file_access["hash"]
+    if file_access["mode"] != "r" or h == None or h not in hashes:
+        return file_access
+
+    db_file, name = hashes[h]
+    if db_file == source or name.split("/")[-1] == file_access["name"].split("/")[-1]:
+        return file_access
+
+    count("file nodes linked by hash")
+    return dict(file_access, name=name)
+
+def merge_trial(result, trial, p_count, d_count, e_count, outfiles, data_dict, finish_node, hashes=None, source=None):
+    """ adds a subgraph from extract_trial to the linked result,
+    replaying its nodes and edges in order so ids match sequential mode
+    file nodes are deduplicated against earlier trials here, using outfiles and data_dict
+    hashes and source: for federated mode, see link_by_hash """
+
+    events, p_total, trial_finish, first_step, script_name = trial
+
+    # processes are numbered after the ones already in result
+    # data nodes are numbered as they are added, since file nodes may be reused
+    p_offset = p_count-1
+    d_keys = {}
+    activation_id_to_p_string = {}
+
+    # informs edge between the Finish of the previous script and the Start of the current script
+    if finish_node!= None:
+        e_count = add_informs_edge(result, finish_node, "p" + str(p_count), e_count)
+
+    for event in events:
+        if event[0] == "file":
+            current_p = renumber(event[1], p_offset, d_keys)
+            s = event[2]
+            activation_id_to_p_string[s[1]] = current_p
+            file_access = event[3]
+            if hashes != None:
+                file_access = link_by_hash(file_access, hashes, source)
+                if file_access["mode"] != "r" and file_access["hash"] != None:
+                    hashes.setdefault(file_access["hash"], (source, file_access["name"]))
+            d_count, e_count = add_file(result, file_access, d_count, e_count, current_p, s, outfiles, first_step, activation_id_to_p_string, data_dict)
+
+        elif event[0] == "activity":
+            # environment node only comes from the first script
+            if event[1] == "environment":
+                if len(result.get('activity', {})) == 0:
+                    result = get_defaults(script_name, result)
+            else:
+                result['activity'][renumber(event[1], p_offset, d_keys)] = event[2]
+
+        elif event[0] == "entity":
+            d_keys[event[1]] = "d" + str(d_count)
+            d_count+=1
+            result['entity'][d_keys[event[1]]] = event[2]
+
+        else: # edges
+            edge = {}
+            for key, value in event[2].items():
+                edge[key] = renumber(value, p_offset, d_keys)
+            result[event[0]]["e" + str(e_count)] = edge
+            e_count+=1
+
+    return result, p_count+p_total, d_count, e_count, renumber(trial_finish, p_offset, d_keys)
+
+def get_trial_cache_key(db, input_db_file, trial_num, snapshot_options, summary=None):
+    """ identifies a converted trial by database, trial id, when the trial finished,
+    the contents of its script and the options it was converted with,
+    so a trial is only reused while none of them change """
+
+    script_name = get_script_name(db, trial_num)
+    finish = db.execute(QUERIES["trial_finish"], (trial_num, )).fetchone()[0]
+    with open(script_name, 'rb') as f:
+        script_hash = hashlib.sha1(f.read()).hexdigest()
+
+    key = [TRIAL_CACHE_VERSION, os.path.abspath(input_db_file), trial_num, finish, script_hash, snapshot_options, summary]
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def load_cached_trial(cache_dir, key):
+    """ returns the cached extract_trial output for key, or None if it is not cached """
+
+    path = os.path.join(cache_dir, key + ".trial")
+    try:
+        with open(path, 'rb') as f:
+            trial = pickle.loads(zlib.decompress(f.read()))
+    except (OSError, zlib.error, pickle.UnpicklingError, EOFError):
+        return None
+
+    # mark as recently used for eviction
+    os.utime(path)
+    return trial
+
+def store_cached_trial(cache_dir, key, trial, cache_max_bytes=TRIAL_CACHE_MAX_BYTES):
+    """ saves extract_trial output as compressed pickle,
+    then removes the least recently used trials until the cache fits in cache_max_bytes """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + ".trial")
+    with atomic_path(path) as temp_path:
+        with open(temp_path, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps(trial, pickle.HIGHEST_PROTOCOL)))
+
+    cached = []
+    for name in os.listdir(cache_dir):
+        # trials still being written by atomic_path are not counted
+        if name.endswith(".trial") and not name.startswith(".tmp"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            cached.append((stat.st_mtime, stat.st_size, name))
+    cached.sort()
+
+    total = sum(c[1] for c in cached)
+    for mtime, size, name in cached:
+        if total <= cache_max_bytes:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
+
+def extract_trials(trial_num_list, input_db_file, index_db_file, snapshot_options, workers=None, cache_dir=None, cache_max_bytes=TRIAL_CACHE_MAX_BYTES, live=False, summary=None):
+    """ yields the extract_trial output of each trial, in order, for merge_trial
+    unchanged trials are loaded from cache_dir, the rest are extracted,
+    in parallel if workers is given, and added to the cache
+    live: the database may still be written to, see open_db
+    summary: from get_summary_options """
+
+    # build the side-car once, before the workers open it
+    if index_db_file:
+        build_index_db(input_db_file, index_db_file)
+
+    keys, cached = {}, {}
+    if cache_dir:
+        with timed("cache"):
+            db = open_db(input_db_file, index_db_file, live)
+            for trial_num in trial_num_list:
+                keys[trial_num] = get_trial_cache_key(db, input_db_file, trial_num, snapshot_options, summary)
+                trial = load_cached_trial(cache_dir, keys[trial_num])
+                if trial != None:
+                    cached[trial_num] = trial
+            db.close()
+
+    missing = [trial_num for trial_num in trial_num_list if trial_num not in cached]
+
+    executor = None
+    if workers:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        extracted = executor.map(extract_trial_timed, repeat(input_db_file), repeat(index_db_file), repeat(snapshot_options), missing, repeat(live), repeat(summary))
+    else:
+        extracted = map(extract_trial, repeat(input_db_file), repeat(index_db_file), repeat(snapshot_options), missing, repeat(live), repeat(summary))
+
+    for trial_num in trial_num_list:
+        if trial_num in cached:
+            yield cached[trial_num]
+        else:
+            if workers:
+                # phase times from the workers are added up
+                trial, times = next(extracted)
+                with phase_lock:
+                    for phase in times:
+                        phase_times[phase] = phase_times.get(phase, 0.0) + times[phase]
+            else:
+                trial = next(extracted)
+            if cache_dir:
+                with timed("cache"):
+                    store_cached_trial(cache_dir, keys[trial_num], trial, cache_max_bytes)
+                cached[trial_num] = trial
+            yield trial
+
+    if executor != None:
+        executor.shutdown()
+
+def extract_database(output, stop, db_file, trial_num_list, index_db_file, snapshot_options, workers=None,
+                     cache_dir=None, cache_max_bytes=TRIAL_CACHE_MAX_BYTES, live=False, summary=None):
+    """ thread of extract_federated_trials: puts the extract_trial output of each trial of one database
+    on the output queue, in order, or the error that stopped it
+    sqlite releases the GIL while it runs queries, so the databases are read at the same time """
+
+    try:
+        for trial in extract_trials(trial_num_list, db_file, index_db_file, snapshot_options, workers, cache_dir, cache_max_bytes, live, summary):
+            # waits while the merge is behind, unless it has stopped
+            while not stop.is_set():
+                try:
+                    output.put(trial, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                return
+    except Exception as e:
+        output.put(e)
+
+def extract_federated_trials(db_trials, snapshot_options, workers=None, cache_dir=None,
+                             cache_max_bytes=TRIAL_CACHE_MAX_BYTES, live=False, summary=None):
+    """ yields (extract_trial output, database) for every trial of several databases, in workflow order
+    db_trials: list of (db_file, trial ids) pairs, or (db_file, trial ids, index_db_file)
+    a database may be listed more than once. each database is opened and queried on its own thread """
+
+    # the trials of each database, and the database of each trial in workflow order
+    databases = OrderedDict()
+    order = []
+    for pair in db_trials:
+        db_file, trial_num_list = pair[0], list(pair[1])
+        index_db_file = pair[2] if len(pair) > 2 else None
+        databases.setdefault(db_file, {"trials": [], "index": index_db_file})["trials"].extend(trial_num_list)
+        order.extend([db_file] * len(trial_num_list))
+
+    stop = threading.Event()
+    queues = {}
+    for db_file in databases:
+        queues[db_file] = queue.Queue(FEDERATED_QUEUE)
+        thread = threading.Thread(target=extract_database, daemon=True,
+                                  args=(queues[db_file], stop, db_file, databases[db_file]["trials"], databases[db_file]["index"],
+                                        snapshot_options, workers, cache_dir, cache_max_bytes, live, summary))
+        thread.start()
 
-def link_DDGs(trial_num_list, input_db_file, output_json_file):
+    try:
+        for db_file in order:
+            trial = queues[db_file].get()
+            if isinstance(trial, Exception):
+                raise trial
+            yield trial, db_file
+    finally:
+        stop.set()
+
+def new_ddg(stream=False, json_backend="auto"):
+    """ makes an empty linked DDG: the result and the variables
+    that carry over from one script to the next """
+
+    # nodes and edges are kept compactly, or spilled to disk, until written
+    if stream:
+        result = get_spill_result(get_json_dumps(json_backend))
+    else:
+        result = get_compact_result()
+
+    return {"result": result, "p_count": 1, "d_count": 1, "e_count": 1,
+            "outfiles": {}, "data_dict": {}, "hashes": {}, "finish_node": None}
+
+def add_trials(ddg, trial_num_list, input_db_file, index_db_file=None, snapshot_options=None, workers=None,
+               cache_dir=None, cache_max_bytes=TRIAL_CACHE_MAX_BYTES, live=False, summary=None, on_trial=None):
+    """ adds the trials, in order, to the end of a DDG from new_ddg, linked to the trials already in it
+    the arguments are those of link_DDGs, snapshot_options from get_snapshot_options
+    on_trial: called with each trial id, or [db_file, id] when federated, once the trial is added """
+
+    result, outfiles, data_dict = ddg["result"], ddg["outfiles"], ddg["data_dict"]
+    p_count, d_count, e_count, finish_node = ddg["p_count"], ddg["d_count"], ddg["e_count"], ddg["finish_node"]
+
+    if input_db_file == None:
+        # federated: (db_file, trial ids) pairs, each database extracted on its own thread, then merged in order
+        hashes = ddg.setdefault("hashes", {})
+        trial_ids = [[pair[0], trial_num] for pair in trial_num_list for trial_num in pair[1]]
+        # the extracted trials come first, so zip runs them to the end
+        for (trial, db_file), trial_id in zip(extract_federated_trials(trial_num_list, snapshot_options, workers, cache_dir, cache_max_bytes, live, summary), trial_ids):
+            with timed("merge"):
+                result, p_count, d_count, e_count, finish_node = merge_trial(result, trial, p_count, d_count, e_count, outfiles, data_dict, finish_node, hashes, db_file)
+            if on_trial != None:
+                on_trial(trial_id)
+
+    elif workers or cache_dir:
+        # trials are extracted in parallel or loaded from the cache, then merged in order
+        for trial, trial_num in zip(extract_trials(trial_num_list, input_db_file, index_db_file, snapshot_options, workers, cache_dir, cache_max_bytes, live, summary), trial_num_list):
+            with timed("merge"):
+                result, p_count, d_count, e_count, finish_node = merge_trial(result, trial, p_count, d_count, e_count, outfiles, data_dict, finish_node)
+            if on_trial != None:
+                on_trial(trial_num)
+
+    else:
+        # one connection for every trial
+        db = open_db(input_db_file, index_db_file, live)
+        snapshots = SnapshotWriter(**snapshot_options)
+
+        # for each trial, query and add to the result
+        for trial_num in trial_num_list:
+            with timed("SQL fetch"):
+                script_steps, func_ends, end_funcs, script_name = get_info_from_sql(db, trial_num)
+            with timed("AST scope index"):
+                scope_index = get_scope_index(script_name)
+            with timed("graph build"):
+                result, p_count, d_count, e_count, outfiles, finish_node, first_step = make_dict(script_steps, db, trial_num, func_ends, end_funcs, p_count, d_count, e_count, outfiles, result, data_dict, finish_node, script_name, scope_index, snapshots, summary)
+            if on_trial != None:
+                on_trial(trial_num)
+
+        snapshots.close()
+        db.close()
+
+    ddg.update({"result": result, "p_count": p_count, "d_count": d_count, "e_count": e_count, "finish_node": finish_node})
+
+def get_counts(result):
+    """ number of nodes and edges in each section """
+
+    counts = {}
+    for key in SECTIONS:
+        counts[key] = len(result.get(key, {}))
+
+    return counts
+
+def link_DDGs(trial_num_list, input_db_file, output_json_file, index_db_file=None, stream=False, workers=None,
+              snapshot_dir=None, snapshot_format="csv", snapshot_max_bytes=None,
+              cache_dir=None, cache_max_bytes=TRIAL_CACHE_MAX_BYTES, output_format=None, json_backend="auto", summary=None,
+              value_max_bytes=None, value_dir=None, shard=None):
     """ input: db_file generated by noworkflow
     target path where the Prov-JSON file will be written
     and a list of trial numbers that will be linked together into a DDG
     where trial numbers correspond to individual scripts stored in the noworkflow database
-
-    output: prov-json file that can be opened in DDG Explorer
+    to link trials of several databases, input_db_file is None and trial_num_list is a list of
+    (db_file, trial ids) pairs in workflow order, or (db_file, trial ids, index_db_file).
+    files read in one database are linked to the files with the same contents written in another
+    optional index_db_file: side-car database holding indexed copies of the queried tables
+    stream: spill nodes and edges to temporary files while converting, for graphs too big for memory
+    workers: number of processes that extract trials in parallel. output is identical to sequential mode
+    snapshot_dir: where dataframe snapshots are written, by default the data directory next to the output's directory.
+    writing to stdout without snapshot_dir, dataframes are kept as data nodes
+    snapshot_format: csv, csv.gz, parquet, feather, or compact (parquet if pyarrow is installed, else csv.gz)
+    snapshot_max_bytes: dataframes with longer return values are not saved
+    cache_dir: directory of converted trials reused across runs, only new or changed trials are queried
+    cache_max_bytes: size of cache_dir, the least recently used trials are removed past it
+    output_format: json, sqlite or parquet. by default sqlite for .sqlite or .db files, parquet for .parquet, else json
+    json_backend: orjson, ujson or json, by default the fastest installed. .gz and .zst Prov-JSON files are compressed
+    summary: from get_summary_options, to bound the size of the DDG by sampling loops and collapsing deep functions
+    value_max_bytes: other return values longer than this are cut to a preview with their length and sha1
+    value_dir: where the full text of those values is written, one file per distinct value
+    shard: 'trial' to write one Prov-JSON shard per trial, or a number of nodes to group trials into shards that big,
+    in a directory next to output_json_file, which becomes their index. see ShardWriter and read_shards
+
+    output: prov-json file that can be opened in DDG Explorer, or stdout if output_json_file is '-'
+    or the same nodes and edges as sqlite or parquet tables
+    returns the number of nodes and edges in each section
     """
 
-    # initialize variables that will carry over from 1 script to the next
-    p_count, d_count, e_count = 1, 1, 1
-    result, outfiles, data_dict = {}, {}, {}
-    finish_node = None
+    # fail before converting if the output cannot be written
+    output_format = get_output_format(output_json_file, output_format)
 
-    # for each trial, query and add to the result
-    for trial_num in trial_num_list:
-        script_steps, files, func_ends, end_funcs, script_name = get_info_from_sql(input_db_file, trial_num)
-        loop_dict = get_loop_locations(script_name)
-        result, p_count, d_count, e_count, outfiles, finish_node = make_dict(script_steps, files, input_db_file, trial_num, func_ends, end_funcs, p_count, d_count, e_count, outfiles, result, data_dict, finish_node, script_name, loop_dict)
+    ddg = new_ddg(stream, json_backend)
+    snapshot_options = get_snapshot_options(output_json_file, snapshot_dir, snapshot_format, snapshot_max_bytes, value_max_bytes, value_dir)
 
-    # Write to file
-    write_json(result, output_json_file)
-
-def main():
+    if shard != None:
+        # shards are written while the trials are added, the index at the end
+        shards = ShardWriter(output_json_file, None if shard == "trial" else int(shard), stream, json_backend)
+        ddg["result"] = shards.get_result()
+        add_trials(ddg, trial_num_list, input_db_file, index_db_file, snapshot_options, workers, cache_dir, cache_max_bytes, summary=summary, on_trial=shards.end_trial)
+        shards.close()
+        return get_counts(ddg["result"])
 
-    # TO DO: how to get these paths?
-    input_db_file = '/Users/jen/Desktop/newNow/scripts/.noworkflow/db.sqlite'
-    output_json_file = "/Users/jen/Desktop/newNow/results/J.json"
+    add_trials(ddg, trial_num_list, input_db_file, index_db_file, snapshot_options, workers, cache_dir, cache_max_bytes, summary=summary)
 
-    # TO DO: how to get these from now list, how to make sure they are in order?
-    trial_num_list = [13]
+    # Write to file
+    write_output(ddg["result"], output_json_file, output_format, json_backend)
+
+    return get_counts(ddg["result"])
+
+def script_matches(command, script):
+    """ whether a trial's command ran script, a name or glob matching its path or file name """
+
+    temp = command.split(" ")
+    return len(temp) > 1 and (fnmatch.fnmatch(temp[1], script) or fnmatch.fnmatch(os.path.basename(temp[1]), script))
+
+def select_trials(db, specs, script=None):
+    """ turns trial specs from the command line into trial ids, in the order given
+    a spec is a comma separated list of ids, ranges like 1-5, globs like 1* or 'all'
+    with script, every trial of that script (name or glob) is added, in id order """
+
+    trials = db.execute(QUERIES["trials"]).fetchall()
+    ids = [t[0] for t in trials]
+    selected = []
+
+    for spec in specs:
+        for item in spec.split(","):
+            if item == "all":
+                selected.extend(ids)
+            elif any(c in item for c in "*?["):
+                selected.extend([i for i in ids if fnmatch.fnmatch(str(i), item)])
+            elif "-" in item:
+                start, end = item.split("-")
+                selected.extend([i for i in ids if int(start) <= i <= int(end)])
+            elif int(item) in ids:
+                selected.append(int(item))
+            else:
+                raise ValueError("no trial " + item + " in the database")
+
+    if script:
+        for t in trials:
+            if script_matches(t[1], script):
+                selected.append(t[0])
+
+    # keep the first of any repeated trial
+    return list(OrderedDict.fromkeys(selected))
+
+def get_new_trials(db, after, script=None, limit=None):
+    """ ids of the finished trials after trial id 'after', in order, and the last id looked at
+    stops at the first trial still running, so trials are always linked in the order they ran
+    with script, only that script's trials are returned
+    with limit, at most that many, the rest are returned by the next call """
+
+    new_trials, last = [], after
+    for trial_num, command, finish in db.execute(QUERIES["new_trials"], (after, )):
+        if finish == None:
+            break
+        if script == None or script_matches(command, script):
+            if limit != None and len(new_trials) >= limit:
+                break
+            new_trials.append(trial_num)
+        last = trial_num
+
+    return new_trials, last
+
+def watch_trials(input_db_file, output_json_file, after=0, script=None, poll_interval=WATCH_POLL, debounce=WATCH_DEBOUNCE,
+                 max_batch=WATCH_MAX_BATCH, stream=False, workers=None, snapshot_dir=None, snapshot_format="csv",
+                 snapshot_max_bytes=None, output_format=None, json_backend="auto", summary=None, on_update=None, max_polls=None,
+                 value_max_bytes=None, value_dir=None, max_pending=WATCH_MAX_PENDING):
+    """ converts trials as noWorkflow adds them to input_db_file, appending each to one rolling linked DDG
+    the trials already linked are never queried again, only the output file is rewritten
+    after: trials up to this id are not linked, by default every finished trial is
+    poll_interval: seconds between checks of the database's change counter, PRAGMA data_version
+    debounce: seconds a finished trial waits before it is converted, with the trials finished meanwhile,
+    so a busy pipeline of short scripts is converted in a few batches, however often it writes to the database
+    max_batch: most trials converted before the output is written again
+    max_pending: most finished trials waiting to be converted, the rest are read from the database as they are
+    on_update: called with the trial ids and the counts after each write
+    max_polls: stop after this many checks, by default runs until interrupted
+    the other arguments are those of link_DDGs """
+
+    output_format = get_output_format(output_json_file, output_format)
+    snapshot_options = get_snapshot_options(output_json_file, snapshot_dir, snapshot_format, snapshot_max_bytes, value_max_bytes, value_dir)
+    ddg = new_ddg(stream, json_backend)
+
+    db = open_db(input_db_file, live=True)
+    # (trial id, when it was seen finished), oldest first
+    pending = deque()
+    version, more = None, False
+    polls = 0
 
-    link_DDGs(trial_num_list, input_db_file, output_json_file)
+    try:
+        while max_polls == None or polls < max_polls:
+            polls += 1
+
+            # data_version only changes when another connection commits, so idle polls do not query trials
+            # when pending is full, the trials past it are read once there is room
+            data_version = db.execute('PRAGMA data_version').fetchone()[0]
+            room = max_pending - len(pending)
+            if (data_version != version or more) and room > 0:
+                version = data_version
+                new_trials, after = get_new_trials(db, after, script, room)
+                more = len(new_trials) == room
+                seen = time.monotonic()
+                for trial_num in new_trials:
+                    pending.append((trial_num, seen))
+
+            if len(pending) > 0 and time.monotonic() - pending[0][1] >= debounce:
+                batch = [pending.popleft()[0] for i in range (0, min(max_batch, len(pending)))]
+                add_trials(ddg, batch, input_db_file, None, snapshot_options, workers, live=True, summary=summary)
+                write_output(ddg["result"], output_json_file, output_format, json_backend)
+                if on_update != None:
+                    on_update(batch, get_counts(ddg["result"]))
+                # more waiting: convert them without sleeping
+                if len(pending) > 0:
+                    continue
+
+            time.sleep(poll_interval)
+    finally:
+        db.close()
+
+    return get_counts(ddg["result"])
+
+def print_stats(counts, elapsed, workers=None):
+    """ prints the time per phase, node and edge counts and throughput to stderr """
+
+    nodes = max(counts["activity"]-1, 0) + counts["entity"]  # without the environment node
+    edges = counts["wasInformedBy"] + counts["wasGeneratedBy"] + counts["used"]
+
+    if workers:
+        print("phase times are added up over " + str(workers) + " worker processes", file=sys.stderr)
+    for phase in phase_times:
+        print("%-24s %10.3fs" % (phase, phase_times[phase]), file=sys.stderr)
+    print("%-24s %10.3fs" % ("total", elapsed), file=sys.stderr)
+    print("%d nodes (%d activities, %d entities), %d edges, %.0f nodes/sec" %
+          (nodes, max(counts["activity"]-1, 0), counts["entity"], edges, nodes / elapsed if elapsed > 0 else 0), file=sys.stderr)
+
+def main(argv=None):
+    if argv == None:
+        argv = sys.argv[1:]
+
+    # subcommands, in their own modules
+    if len(argv) > 0 and argv[0] == "lineage":
+        import ddg_query
+        ddg_query.main(argv[1:])
+        return
+    if len(argv) > 0 and argv[0] == "diff":
+        import ddg_diff
+        ddg_diff.main(argv[1:])
+        return
+
+    parser = argparse.ArgumentParser(description="Converts noWorkflow trials into one linked Prov-JSON DDG that can be opened in DDG Explorer.",
+                                     epilog="sql_to_json.py lineage -h shows how to query the lineage of a converted DDG, "
+                                            "sql_to_json.py diff -h how to compare two trials.")
+    parser.add_argument("db", help="database noWorkflow created, ie path/to/.noworkflow/db.sqlite")
+    parser.add_argument("trials", nargs="*", help="trials to link, in workflow order: ids, ranges like 1-5, globs like 1* or all")
+    parser.add_argument("--script", help="also link every trial of this script, by name or glob")
+    parser.add_argument("--db", nargs=2, action="append", default=[], dest="databases", metavar=("DB", "TRIALS"),
+                        help="then link these trials of another noWorkflow database, repeatable. files are linked across databases by contents")
+    parser.add_argument("-o", "--output", default="-", help="Prov-JSON file to write, - for stdout (default). .gz or .zst files are compressed, "
+                                                            ".sqlite, .db and .parquet outputs are tables")
+    parser.add_argument("--format", choices=["json", "sqlite", "parquet"], help="output format (default: from the output's extension)")
+    parser.add_argument("--json-backend", default="auto", choices=["auto"] + JSON_BACKENDS, help="json module for Prov-JSON (default: the fastest installed)")
+    parser.add_argument("--index-db", help="side-car database with indexed copies of the queried tables")
+    parser.add_argument("--stream", action="store_true", help="spill the graph to temporary files while converting")
+    parser.add_argument("--shard", help="write one Prov-JSON file per trial ('trial'), or per this many nodes, "
+                                        "with the output as their index")
+    parser.add_argument("--workers", type=int, help="extract trials in this many processes")
+    parser.add_argument("--snapshot-dir", help="where dataframe snapshots are written (default: data next to the output's directory, none for stdout)")
+    parser.add_argument("--snapshot-format", default="csv", choices=sorted(SNAPSHOT_FORMATS) + ["compact"])
+    parser.add_argument("--snapshot-max-bytes", type=int, help="do not save dataframes with longer return values")
+    parser.add_argument("--value-max-bytes", type=int, help="cut other return values longer than this to a preview with their length and sha1")
+    parser.add_argument("--value-dir", help="with --value-max-bytes, write the full values there, one file per distinct value")
+    parser.add_argument("--cache-dir", help="reuse trials converted by earlier runs")
+    parser.add_argument("--cache-max-bytes", type=int, default=TRIAL_CACHE_MAX_BYTES)
+    parser.add_argument("--stats", action="store_true", help="print time per phase, node and edge counts to stderr")
+    parser.add_argument("--explain", action="store_true", help="print the query plan of each query to stderr")
+    parser.add_argument("--profile", action="store_true", help="print calls and time per function, and counters, to stderr. only covers this process, not --workers")
+    parser.add_argument("--loop-first", type=int, help="summarise loops: only the first N iterations get nodes, the rest are counted in a summary node")
+    parser.add_argument("--loop-last", type=int, help="summarise loops: the last N iterations get nodes too")
+    parser.add_argument("--loop-every", type=int, help="summarise loops: every Kth iteration gets nodes too")
+    parser.add_argument("--max-depth", type=int, help="collapse functions called deeper than this into one node, 0 for every function")
+    parser.add_argument("--watch", action="store_true", help="keep running, appending trials to the output as they finish. "
+                                                             "links the trials after --after, or of --script, instead of the trials given")
+    parser.add_argument("--after", type=int, default=0, help="with --watch, do not link trials up to this id")
+    parser.add_argument("--poll", type=float, default=WATCH_POLL, help="with --watch, seconds between checks of the database")
+    parser.add_argument("--debounce", type=float, default=WATCH_DEBOUNCE, help="with --watch, seconds a finished trial waits, to be converted with the trials finished meanwhile")
+    parser.add_argument("--max-batch", type=int, default=WATCH_MAX_BATCH, help="with --watch, most trials converted between writes of the output")
+    parser.add_argument("--max-pending", type=int, default=WATCH_MAX_PENDING, help="with --watch, most finished trials waiting to be converted")
+    args = parser.parse_args(argv)
+    summary = get_summary_options(args.loop_first, args.loop_last, args.loop_every, args.max_depth)
+    if args.shard and args.shard != "trial" and not args.shard.isdigit():
+        parser.error("--shard is 'trial' or a number of nodes")
+
+    if args.watch:
+        if len(args.trials) > 0 or len(args.databases) > 0:
+            parser.error("--watch links new trials of one database, use --after or --script instead of trial ids")
+        if args.output == "-":
+            parser.error("--watch needs an output file")
+        if args.shard:
+            parser.error("--watch rewrites one output file, it cannot be sharded")
+
+        def on_update(batch, counts):
+            print("linked trials " + ", ".join([str(t) for t in batch]) + ": " + str(counts["activity"] - 1 + counts["entity"]) + " nodes", file=sys.stderr)
+
+        try:
+            watch_trials(args.db, args.output, args.after, args.script, args.poll, args.debounce, args.max_batch,
+                         args.stream, args.workers, args.snapshot_dir, args.snapshot_format, args.snapshot_max_bytes,
+                         args.format, args.json_backend, summary, on_update,
+                         value_max_bytes=args.value_max_bytes, value_dir=args.value_dir, max_pending=args.max_pending)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    db = open_db(args.db, args.index_db)
+    try:
+        trial_num_list = select_trials(db, args.trials, args.script)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.explain and len(trial_num_list) > 0:
+        print(explain_queries(db, trial_num_list[0]), file=sys.stderr)
+    db.close()
+
+    # trials of other databases, linked after these
+    input_db_file, index_db_file, selected = args.db, args.index_db, len(trial_num_list)
+    if len(args.databases) > 0:
+        trial_num_list = [(args.db, trial_num_list, args.index_db)]
+        for db_file, spec in args.databases:
+            db = open_db(db_file)
+            try:
+                trial_num_list.append((db_file, select_trials(db, [spec])))
+            except ValueError as e:
+                parser.error(db_file + ": " + str(e))
+            db.close()
+            selected += len(trial_num_list[-1][1])
+        input_db_file, index_db_file = None, None
+    if selected == 0:
+        parser.error("no trials selected")
+
+    if args.profile:
+        profile = ProfileSummary()
+        add_profile_hook(profile)
+
+    start = time.perf_counter()
+    counts = link_DDGs(trial_num_list, input_db_file, args.output, index_db_file, args.stream, args.workers,
+                       args.snapshot_dir, args.snapshot_format, args.snapshot_max_bytes,
+                       args.cache_dir, args.cache_max_bytes, args.format, args.json_backend, summary,
+                       args.value_max_bytes, args.value_dir, args.shard)
+    elapsed = time.perf_counter() - start
+
+    if args.stats:
+        print_stats(counts, elapsed, args.workers)
+    if args.profile:
+        print(profile.report(), file=sys.stderr)
 
     # TO DO: how to open DDG Explorer automatically?
 
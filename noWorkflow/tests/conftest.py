@@ -0,0 +1,31 @@
+import os
+import sys
+
+# the modules are run as scripts from noWorkflow/, so the tests import them the same way
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import sql_to_json
+from make_synthetic_db import make_synthetic_db
+
+# sizes of the synthetic database behind synthetic_ddg
+SYNTHETIC_DDG = {"activations": 500, "functions": 3, "loops": 3, "file_accesses": 10,
+                 "object_values": 50, "snapshots": 3, "trials": 2}
+
+@pytest.fixture(scope="module")
+def synthetic_ddg(request, tmp_path_factory):
+    """ a synthetic database of linked trials, each reading the files the one before wrote,
+    and its Prov-JSON from the json module in results/ddg.json, as (db_file, output_file)
+    parametrise it indirectly with a dict to change the sizes in SYNTHETIC_DDG """
+
+    knobs = dict(SYNTHETIC_DDG)
+    knobs.update(getattr(request, "param", {}))
+
+    directory = str(tmp_path_factory.mktemp("synthetic"))
+    db_file = make_synthetic_db(directory, **knobs)
+    os.makedirs(os.path.join(directory, "results"))
+    output_file = os.path.join(directory, "results", "ddg.json")
+    sql_to_json.link_DDGs(list(range (1, knobs["trials"]+1)), db_file, output_file, json_backend="json")
+
+    return db_file, output_file
@@ -0,0 +1,39 @@
+import ddg_diff
+
+def recursive_trial(depth, value):
+    """ events of a trial that recurses depth calls deep, the innermost call returning value """
+
+    events = []
+    for i in range (1, depth+1):
+        events.append(("activity", "p" + str(i), {"rdt:type": "Start", "rdt:name": "f", "rdt:startLine": "2"}))
+    leaf = depth + 1
+    events.append(("activity", "p" + str(leaf), {"rdt:type": "Operation", "rdt:name": "g", "rdt:startLine": "3"}))
+    events.append(("entity", "d1", {"rdt:value": value}))
+    events.append(("wasGeneratedBy", "e1", {"prov:activity": "p" + str(leaf), "prov:entity": "d1"}))
+    for i in range (leaf+1, leaf+depth+1):
+        events.append(("activity", "p" + str(i), {"rdt:type": "Finish", "rdt:name": "f"}))
+
+    return events, leaf + depth, "p" + str(leaf + depth), None, "script.py"
+
+def test_deep_recursion():
+    # deeper than python's recursion limit
+    depth = 3000
+    a = ddg_diff.build_tree(recursive_trial(depth, "1"))
+    b = ddg_diff.build_tree(recursive_trial(depth, "2"))
+
+    report = ddg_diff.diff_trees(a, b)
+    assert not report["identical"]
+    assert report["counts"]["changed"] == 1
+    assert report["counts"]["steps changed"] == 1
+    change = report["changes"][0]
+    assert change["a"]["values"] == ["1"] and change["b"]["values"] == ["2"]
+    assert len(change["path"]) == depth
+    assert report["parent"] == 0
+
+def test_identical_trials():
+    a = ddg_diff.build_tree(recursive_trial(10, "1"))
+    b = ddg_diff.build_tree(recursive_trial(10, "1"))
+
+    report = ddg_diff.diff_trees(a, b)
+    assert report["identical"]
+    assert report["changes"] == []
@@ -0,0 +1,73 @@
+import pytest
+
+import sql_to_json
+from ddg_query import EDGES, LineageIndex
+
+@pytest.fixture(scope="module")
+def ddg(synthetic_ddg):
+    """ the DDG of two linked trials, the second reading the files the first wrote """
+
+    return sql_to_json.read_ddg(synthetic_ddg[1])
+
+def brute_force_closure(ddg, node_id, downstream=False, informs=False):
+    """ every node reachable from node_id, following the edges of the Prov-JSON itself """
+
+    edges = {}
+    for key, source, target in EDGES:
+        if key == "wasInformedBy" and not informs:
+            continue
+        for edge in ddg[key].values():
+            if downstream:
+                edges.setdefault(edge[source], []).append(edge[target])
+            else:
+                edges.setdefault(edge[target], []).append(edge[source])
+
+    seen = set([node_id])
+    stack = [node_id]
+    while len(stack) > 0:
+        for n in edges.get(stack.pop(), []):
+            if n not in seen:
+                seen.add(n)
+                stack.append(n)
+    seen.discard(node_id)
+
+    return seen
+
+def node_ids(ddg):
+    return list(ddg["activity"]) + list(ddg["entity"])
+
+@pytest.mark.parametrize("informs", [False, True])
+@pytest.mark.parametrize("downstream", [False, True])
+def test_lineage_matches_brute_force(ddg, informs, downstream):
+    index = LineageIndex(ddg, informs)
+
+    for node_id in node_ids(ddg):
+        lineage = index.lineage(node_id, downstream)
+        assert len(lineage) == len(set(lineage))
+        assert set(lineage) == brute_force_closure(ddg, node_id, downstream, informs)
+
+def test_cached_closure_reused_partway(ddg):
+    index = LineageIndex(ddg, informs=True)
+
+    # a file with an upstream lineage, and a node further down whose traversal reaches it
+    files = [i for i in ddg["entity"] if ddg["entity"][i]["rdt:type"] == "File" and len(brute_force_closure(ddg, i, informs=True)) > 0]
+    assert len(files) > 0
+    file_id = files[0]
+    later = [i for i in node_ids(ddg) if file_id in brute_force_closure(ddg, i, informs=True)]
+    assert len(later) > 0
+
+    assert set(index.upstream(file_id)) == brute_force_closure(ddg, file_id, informs=True)
+    assert (index.numbers[file_id], False) in index.closures
+
+    for node_id in later:
+        assert set(index.upstream(node_id)) == brute_force_closure(ddg, node_id, informs=True)
+
+    # and the cached closure itself is returned as is
+    assert set(index.upstream(file_id)) == brute_force_closure(ddg, file_id, informs=True)
+
+def test_node_type_filter(ddg):
+    index = LineageIndex(ddg)
+
+    for node_id in ddg["entity"]:
+        files = set(i for i in brute_force_closure(ddg, node_id, True) if index.node(i)[0] == "File")
+        assert set(index.downstream(node_id, "File")) == files
@@ -0,0 +1,78 @@
+import sqlite3
+
+import sql_to_json
+from make_synthetic_db import make_synthetic_db
+
+def old_func_ends(db, run_num):
+    """ func_ends and end_funcs as get_info_from_sql computed them with one query per function """
+
+    c = db.cursor()
+    c.execute('SELECT name, trial_id, last_line from function_def where trial_id = ?', (run_num, ))
+    func_ends = c.fetchall()
+
+    temp = {}
+    end_funcs = {}
+    for f in func_ends:
+        temp[f[0]] = f[2]
+        end_funcs[f[2]] = f[0]
+    func_ends = temp
+
+    for f in func_ends:
+        c.execute('SELECT trial_id, name, return_value from function_activation where trial_id = ? and name = ?', (run_num, f, ))
+        calls = c.fetchall()
+        for call in calls:
+            if call[2]!="None":
+                func_ends[f]-=1
+                temp = func_ends[f]
+                end_funcs[temp]=f
+
+    c.close()
+
+    return func_ends, end_funcs
+
+def make_fixture(directory):
+    """ a synthetic database, plus functions called several times with NULL, 'None' and other return values
+    and a function that is never called """
+
+    db_file = make_synthetic_db(str(directory), activations=200, functions=3, loops=2, file_accesses=4,
+                                object_values=20, snapshots=2, trials=2)
+
+    db = sqlite3.connect(db_file)
+    for trial_num in (1, 2):
+        db.executemany('INSERT INTO function_def (trial_id, name, last_line) VALUES (?, ?, ?)',
+                       [(trial_num, "g", 80), (trial_num, "h", 90), (trial_num, "never_called", 100)])
+        db.executemany('INSERT INTO function_activation (trial_id, name, line, return_value) VALUES (?, ?, ?, ?)',
+                       [(trial_num, "g", 1, "1"), (trial_num, "g", 1, None), (trial_num, "g", 1, "None"),
+                        (trial_num, "g", 1, "[1, 2]"), (trial_num, "h", 1, None), (trial_num, "h", 1, "None")])
+    # a return value in the other trial only
+    db.execute('INSERT INTO function_activation (trial_id, name, line, return_value) VALUES (?, ?, ?, ?)', (2, "h", 1, "3"))
+    db.commit()
+    db.close()
+
+    return db_file
+
+def test_func_ends_match_per_function_queries(tmp_path):
+    db_file = make_fixture(tmp_path)
+    db = sql_to_json.open_db(db_file)
+
+    for trial_num in (1, 2):
+        script_steps, func_ends, end_funcs, script_name = sql_to_json.get_info_from_sql(db, trial_num)
+        assert (func_ends, end_funcs) == old_func_ends(db, trial_num)
+
+    db.close()
+
+def test_func_ends_adjustment(tmp_path):
+    db_file = make_fixture(tmp_path)
+    db = sql_to_json.open_db(db_file)
+
+    script_steps, func_ends, end_funcs, script_name = sql_to_json.get_info_from_sql(db, 1)
+    # three calls of g return something other than 'None', one of them NULL
+    assert func_ends["g"] == 77
+    assert func_ends["h"] == 89
+    assert func_ends["never_called"] == 100
+    assert end_funcs[80] == "g" and end_funcs[77] == "g"
+
+    script_steps, func_ends, end_funcs, script_name = sql_to_json.get_info_from_sql(db, 2)
+    assert func_ends["h"] == 88
+
+    db.close()
@@ -0,0 +1,75 @@
+import os
+import json
+
+import pytest
+
+import sql_to_json
+
+def has_zstd():
+    try:
+        from compression import zstd
+    except ImportError:
+        try:
+            import zstandard
+        except ImportError:
+            return False
+    return True
+
+def convert(synthetic_ddg, name, **options):
+    db_file, output_file = synthetic_ddg
+    path = os.path.join(os.path.dirname(output_file), name)
+    sql_to_json.link_DDGs([1, 2], db_file, path, **options)
+    return path
+
+def load(path):
+    with open(path, encoding="utf-8") as infile:
+        return json.load(infile)
+
+def assert_same_ddg(result, expected):
+    """ same sections, with the same nodes and edges in the same order """
+
+    assert list(result) == sql_to_json.SECTIONS
+    for key in sql_to_json.SECTIONS:
+        assert list(result[key].items()) == list(expected[key].items())
+
+@pytest.mark.parametrize("name", ["ddg.json.gz", "ddg.json.zst", "ddg.sqlite", "ddg.parquet"])
+def test_read_ddg_round_trip(synthetic_ddg, name):
+    if name.endswith(".zst") and not has_zstd():
+        pytest.skip("needs python 3.14 or zstandard")
+    if name.endswith(".parquet"):
+        pytest.importorskip("pyarrow")
+
+    path = convert(synthetic_ddg, name, json_backend="json")
+    assert_same_ddg(sql_to_json.read_ddg(path), load(synthetic_ddg[1]))
+
+def test_read_ddg_json(synthetic_ddg):
+    assert_same_ddg(sql_to_json.read_ddg(synthetic_ddg[1]), load(synthetic_ddg[1]))
+
+@pytest.mark.parametrize("backend", ["orjson", "ujson"])
+def test_json_backends(synthetic_ddg, backend):
+    pytest.importorskip(backend)
+
+    path = convert(synthetic_ddg, "ddg-" + backend + ".json", json_backend=backend)
+    assert_same_ddg(load(path), load(synthetic_ddg[1]))
+
+def test_stream_same_bytes(synthetic_ddg):
+    path = convert(synthetic_ddg, "ddg-stream.json", json_backend="json", stream=True)
+
+    with open(path, "rb") as streamed, open(synthetic_ddg[1], "rb") as expected:
+        assert streamed.read() == expected.read()
+
+def test_workers_same_bytes(synthetic_ddg):
+    path = convert(synthetic_ddg, "ddg-workers.json", json_backend="json", workers=2)
+
+    with open(path, "rb") as parallel, open(synthetic_ddg[1], "rb") as expected:
+        assert parallel.read() == expected.read()
+
+def test_cache_same_bytes(synthetic_ddg, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+
+    # the first run fills the cache, the second only links the cached trials
+    for name in ("ddg-cache1.json", "ddg-cache2.json"):
+        path = convert(synthetic_ddg, name, json_backend="json", cache_dir=cache_dir)
+        with open(path, "rb") as cached, open(synthetic_ddg[1], "rb") as expected:
+            assert cached.read() == expected.read()
+    assert len(os.listdir(cache_dir)) == 2
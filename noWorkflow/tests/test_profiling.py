@@ -0,0 +1,46 @@
+import time
+import tracemalloc
+
+import sql_to_json
+from benchmark import StageMemory
+
+@sql_to_json.profiled
+def sleeper():
+    time.sleep(0.05)
+
+def test_profiled_calls_not_in_phase_times():
+    summary = sql_to_json.ProfileSummary()
+    sql_to_json.add_profile_hook(summary)
+    sql_to_json.phase_times.clear()
+    try:
+        with sql_to_json.timed("outer"):
+            sleeper()
+            with sql_to_json.timed("inner"):
+                time.sleep(0.05)
+    finally:
+        sql_to_json.remove_profile_hook(summary)
+
+    # the call is part of the outer phase, the nested phase is not
+    assert list(sql_to_json.phase_times) == ["inner", "outer"]
+    assert sql_to_json.phase_times["outer"] >= 0.05
+    assert sql_to_json.phase_times["outer"] < 0.1
+    # the hooks still get the call, with its own time left out of the phase around it
+    assert summary.calls["sleeper"] == 1
+    assert summary.seconds["outer"] < 0.05
+
+def test_stage_memory_keeps_peak_before_nested_stage():
+    hook = StageMemory()
+    tracemalloc.start()
+    sql_to_json.add_profile_hook(hook)
+    try:
+        with sql_to_json.timed("outer"):
+            spike = bytearray(20 * 10**6)
+            del spike
+            with sql_to_json.timed("inner"):
+                pass
+    finally:
+        sql_to_json.remove_profile_hook(hook)
+        tracemalloc.stop()
+
+    assert hook.peaks["outer"] >= 20 * 10**6
+    assert hook.peaks["inner"] < 10**6
@@ -0,0 +1,92 @@
+import os
+import json
+import sqlite3
+
+import sql_to_json
+from make_synthetic_db import SCHEMA
+
+SCRIPT = """def f(x):
+    for k in range(x):
+        print(k)
+    return x
+
+for i in range(2):
+    for j in range(2):
+        print(i,
+              j)
+total = f(2)
+y = helper(total)
+print(y)
+"""
+
+# (name, line, return value) of each step. helper is defined in another file,
+# so its step len is on a line of that file
+STEPS = [("range", 6, "range(0, 2)"),
+         ("range", 7, "range(0, 2)"), ("print", 8, "None"), ("print", 8, "None"),
+         ("range", 7, "range(0, 2)"), ("print", 8, "None"), ("print", 8, "None"),
+         ("f", 10, "2"), ("range", 2, "range(0, 2)"), ("print", 3, "None"), ("print", 3, "None"),
+         ("helper", 11, "3"), ("len", 4, "None"),
+         ("print", 12, "None")]
+
+# last lines from the database, one less for each call with a return value
+FUNCTION_DEFS = [("f", 4), ("helper", 5)]
+
+def make_scope_db(directory):
+    """ a database of one trial of SCRIPT, returning its path """
+
+    script_name = os.path.join(str(directory), "script.py")
+    with open(script_name, "w") as f:
+        f.write(SCRIPT)
+
+    os.makedirs(os.path.join(str(directory), ".noworkflow"))
+    db_file = os.path.join(str(directory), ".noworkflow", "db.sqlite")
+    db = sqlite3.connect(db_file)
+    db.executescript(SCHEMA)
+    db.execute('INSERT INTO trial (id, script, command) VALUES (?, ?, ?)', (1, script_name, "python " + script_name))
+    db.executemany('INSERT INTO function_activation (trial_id, name, line, return_value) VALUES (?, ?, ?, ?)',
+                   [(1, script_name, 0, "None")] + [(1, ) + step for step in STEPS])
+    db.executemany('INSERT INTO function_def (trial_id, name, last_line) VALUES (?, ?, ?)',
+                   [(1, ) + f for f in FUNCTION_DEFS])
+    db.commit()
+    db.close()
+
+    return db_file
+
+def get_steps(directory):
+    """ (type, name) of the process nodes, in order """
+
+    db_file = make_scope_db(directory)
+    output_file = os.path.join(str(directory), "ddg.json")
+    sql_to_json.link_DDGs([1], db_file, output_file, json_backend="json")
+    with open(output_file) as infile:
+        activities = json.load(infile)["activity"]
+
+    return [(node["rdt:type"], node["rdt:name"]) for node_id, node in activities.items() if node_id != "environment"]
+
+def test_scope_stack(tmp_path):
+    script = os.path.join(str(tmp_path), "script.py")
+
+    assert get_steps(tmp_path) == [
+        ("Start", script),
+        # nested loops ending on the same line both finish, and the inner one starts again for each outer iteration
+        ("Start", "for i in range(2):"),
+        ("Start", "for j in range(2):"),
+        ("Operation", "print"), ("Operation", "print"),
+        ("Finish", "for j in range(2):"),
+        ("Start", "for j in range(2):"),
+        ("Operation", "print"), ("Operation", "print"),
+        ("Finish", "for j in range(2):"),
+        ("Finish", "for i in range(2):"),
+        # a loop in a function finishes before the function
+        ("Start", "f"),
+        ("Start", "for k in range(x):"),
+        ("Operation", "print"), ("Operation", "print"),
+        ("Finish", "for k in range(x):"),
+        ("Finish", "f"),
+        # a function defined elsewhere ends on its last line from the database
+        ("Start", "helper"),
+        ("Operation", "len"),
+        ("Finish", "helper"),
+        ("Operation", "print"),
+        ("Finish", script),
+    ]
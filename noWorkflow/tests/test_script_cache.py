@@ -0,0 +1,34 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import sql_to_json
+
+def test_script_cache_threads(tmp_path):
+    # more scripts than the cache holds, so threads evict each other's scripts
+    scripts = []
+    for k in range (0, sql_to_json.SCRIPT_CACHE_SIZE + 8):
+        script_name = os.path.join(str(tmp_path), "script%d.py" % k)
+        with open(script_name, "w") as f:
+            f.write("for i in range(%d):\n    print(i)\n" % k)
+        scripts.append(script_name)
+
+    def lookup(offset):
+        for i in range (0, 400):
+            script_name = scripts[(i * 7 + offset) % len(scripts)]
+            scope_index = sql_to_json.get_scope_index(script_name)
+            assert sql_to_json.scope_of(scope_index, 2)["name"] == sql_to_json.get_line(sql_to_json.get_script_info(script_name), 1).strip()
+            with sql_to_json.timed("lookup"):
+                pass
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    sql_to_json.phase_times.clear()
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lookup, range (0, 8)))
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert len(sql_to_json.script_cache) <= sql_to_json.SCRIPT_CACHE_SIZE
+    assert "lookup" in sql_to_json.phase_times
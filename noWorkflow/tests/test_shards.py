@@ -0,0 +1,57 @@
+import os
+import json
+
+import pytest
+
+import sql_to_json
+
+pytestmark = pytest.mark.parametrize("synthetic_ddg", [{"trials": 3}], indirect=True)
+
+def shard(synthetic_ddg, name, shard):
+    db_file, output_file = synthetic_ddg
+    path = os.path.join(os.path.dirname(output_file), name)
+    sql_to_json.link_DDGs([1, 2, 3], db_file, path, json_backend="json", shard=shard)
+    return path
+
+def load(path):
+    with open(path, encoding="utf-8") as infile:
+        return json.load(infile)
+
+def assert_no_dangling_edges(ddg):
+    """ both nodes of every edge were loaded """
+
+    for key in sql_to_json.SECTIONS:
+        if key in ("activity", "entity"):
+            continue
+        for edge_id, edge in ddg[key].items():
+            for node in edge.values():
+                assert node in ddg["activity"] or node in ddg["entity"], (key, edge_id, node)
+
+def test_every_shard(synthetic_ddg):
+    path = shard(synthetic_ddg, "ddg-trial.json", "trial")
+    expected = load(synthetic_ddg[1])
+
+    result = sql_to_json.read_shards(path)
+    for key in sql_to_json.SECTIONS:
+        assert result[key] == expected[key]
+
+@pytest.mark.parametrize("trials", [[1], [2], [3], [1, 3]])
+def test_some_shards(synthetic_ddg, trials):
+    path = shard(synthetic_ddg, "ddg-some.json", "trial")
+    expected = load(synthetic_ddg[1])
+
+    result = sql_to_json.read_shards(path, trials=trials)
+    assert_no_dangling_edges(result)
+    assert 0 < len(result["activity"]) < len(expected["activity"])
+    for key in sql_to_json.SECTIONS:
+        for item_id, item in result[key].items():
+            assert expected[key][item_id] == item
+
+def test_same_shard_edges(synthetic_ddg):
+    # every trial fits in the one shard, so the edges between them stay in it
+    path = shard(synthetic_ddg, "ddg-one.json", 10**9)
+    index = load(path)
+
+    assert len(index["shards"]) == 1
+    assert index["wasInformedBy"] == {}
+    assert_no_dangling_edges(sql_to_json.read_shards(path))
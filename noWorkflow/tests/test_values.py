@@ -0,0 +1,53 @@
+import os
+import hashlib
+
+import sql_to_json
+
+def test_value_max_bytes_counts_utf8_bytes(tmp_path):
+    snapshots = sql_to_json.SnapshotWriter(str(tmp_path), str(tmp_path), value_max_bytes=10)
+
+    # 5 two-byte characters fit in 10 bytes, 6 do not
+    assert snapshots.add_value("é" * 5) == "é" * 5
+    value = "é" * 6
+    digest = hashlib.sha1(value.encode()).hexdigest()
+    assert snapshots.add_value(value) == "é" * 5 + "... (12 bytes, sha1 " + digest + ")"
+    assert snapshots.add_value("a" * 10) == "a" * 10
+    snapshots.close()
+
+def test_value_preview_cut_on_character_boundary(tmp_path):
+    snapshots = sql_to_json.SnapshotWriter(str(tmp_path), str(tmp_path), value_max_bytes=11, value_dir=str(tmp_path / "values"))
+
+    value = "a" + "€" * 10
+    stored = snapshots.add_value(value)
+    # a and three 3-byte characters are 10 bytes, the fourth would go past 11
+    assert stored.startswith("a€€€... (31 bytes, sha1 ")
+    snapshots.close()
+
+    path = os.path.join(str(tmp_path), "values", "value-" + hashlib.sha1(value.encode()).hexdigest() + ".txt")
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == value
+
+def test_snapshot_max_bytes_counts_utf8_bytes(tmp_path):
+    snapshots = sql_to_json.SnapshotWriter(str(tmp_path), str(tmp_path), max_bytes=10)
+
+    table = (["a"], [["é"]])
+    assert snapshots.add(table, "é" * 6, "script.py") == None
+    assert snapshots.add(table, "é" * 5, "script.py") != None
+    snapshots.close()
+
+def test_atomic_path_failure_keeps_file(tmp_path):
+    path = str(tmp_path / "value.txt")
+    with open(path, "w") as f:
+        f.write("old")
+
+    try:
+        with sql_to_json.atomic_path(path) as temp_path:
+            with open(temp_path, "w") as f:
+                f.write("half")
+            raise ValueError("write failed")
+    except ValueError:
+        pass
+
+    with open(path) as f:
+        assert f.read() == "old"
+    assert os.listdir(str(tmp_path)) == ["value.txt"]
@@ -0,0 +1,50 @@
+import os
+import time
+import sqlite3
+import threading
+
+import sql_to_json
+from make_synthetic_db import make_synthetic_db
+
+def watch_busy_db(directory, **options):
+    """ runs watch_trials on a synthetic database of two finished trials while another connection
+    commits every 50ms, returning the batches converted and whether the writer was still busy for each """
+
+    db_file = make_synthetic_db(str(directory), activations=200, functions=2, loops=2, file_accesses=4,
+                                object_values=20, snapshots=1, trials=2)
+    output_file = os.path.join(str(directory), "results", "ddg.json")
+    os.makedirs(os.path.dirname(output_file))
+
+    stop = threading.Event()
+    def write():
+        db = sqlite3.connect(db_file)
+        while not stop.is_set():
+            db.execute('UPDATE trial SET start = ? WHERE id = 1', (str(time.time()), ))
+            db.commit()
+            time.sleep(0.05)
+        db.close()
+
+    updates = []
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        counts = sql_to_json.watch_trials(db_file, output_file, poll_interval=0.02, debounce=0.1, max_polls=50,
+                                          json_backend="json", on_update=lambda batch, counts: updates.append((batch, not stop.is_set())),
+                                          **options)
+    finally:
+        stop.set()
+        writer.join()
+
+    return updates, counts, output_file
+
+def test_watch_converts_while_database_is_busy(tmp_path):
+    updates, counts, output_file = watch_busy_db(tmp_path)
+
+    assert updates == [([1, 2], True)]
+    assert counts == sql_to_json.get_counts(sql_to_json.read_ddg(output_file))
+
+def test_watch_max_pending(tmp_path):
+    updates, counts, output_file = watch_busy_db(tmp_path, max_pending=1)
+
+    # one trial waits at a time, the second is read once the first is converted
+    assert updates == [([1], True), ([2], True)]